@@ -336,6 +336,89 @@ def score_tf_idf(
     return df, contribution
 
 
+def score_tf_token_corpus(token_corpus, expanded_words):
+    """score a token corpus using term freq with NumPy, the dimensions are sorted alphabetically.
+    Gives the same scores as score_tf on the documents of the token corpus.
+
+    Arguments:
+        token_corpus {Utils.token_corpus.TokenCorpus} -- an integer-encoded corpus
+        expanded_words {dict[str, set(str)]} -- dictionary for scoring
+
+    Returns:
+        pandas.DataFrame -- a dataframe with columns: Doc_ID, dim1, dim2, ..., document_length
+    """
+    n_doc = token_corpus.n_documents
+    results = {}
+    for dimension in sorted(expanded_words.keys()):
+        docs, _, counts = token_corpus.document_word_counts(
+            token_corpus.word_ids(expanded_words[dimension])
+        )
+        results[dimension] = np.bincount(docs, weights=counts, minlength=n_doc).astype(np.int64)
+    results["document_length"] = token_corpus.document_lengths()
+    df = pd.DataFrame(results)
+    df["Doc_ID"] = list(token_corpus.doc_ids)
+    return df
+
+
+def score_tf_idf_token_corpus(
+    token_corpus,
+    expanded_words,
+    df_array,
+    method="TFIDF",
+    word_weights=None,
+    normalize=False,
+):
+    """Calculate tf-idf score for a token corpus with NumPy.
+    Gives the same scores as score_tf_idf on the documents of the token corpus.
+
+    Arguments:
+        token_corpus {Utils.token_corpus.TokenCorpus} -- an integer-encoded corpus
+        expanded_words {{dim: set(str)}}} -- dictionary
+        df_array {numpy.ndarray} -- document frequency of each word ID (TokenCorpus.document_frequency)
+
+    Keyword Arguments:
+        method {str} -- TFIDF, WFIDF, TFIDF+SIMWEIGHT or WFIDF+SIMWEIGHT, see score_tf_idf (default: {TFIDF})
+        word_weights {{word:weight}} -- a dictionary of word weights (e.g. similarity weights) (default: None)
+        normalize {bool} -- normalized the L2 norm to one for each document (default: {False})
+
+    Returns:
+        [df] -- a dataframe with columns: Doc_ID, dim1, dim2, ..., document_length
+        [contribution] -- a dict of total contribution (sum of scores in the corpus) for each word
+    """
+    if method not in ("TFIDF", "WFIDF", "TFIDF+SIMWEIGHT", "WFIDF+SIMWEIGHT"):
+        raise Exception(
+            "The method can only be TFIDF, WFIDF, TFIDF+SIMWEIGHT, or WFIDF+SIMWEIGHT"
+        )
+    print("Scoring using {}".format(method))
+    n_doc = token_corpus.n_documents
+    document_lengths = token_corpus.document_lengths()
+    contribution = defaultdict(int)
+    dimensions = sorted(expanded_words.keys())
+    results = np.zeros((n_doc, len(dimensions) + 1))
+    for d, dimension in enumerate(dimensions):
+        docs, words, counts = token_corpus.document_word_counts(
+            token_corpus.word_ids(expanded_words[dimension])
+        )
+        idf = np.log(n_doc / df_array[words])
+        if method.startswith("WFIDF"):
+            w_ij = (1 + np.log(counts)) * idf
+        else:
+            w_ij = counts * idf
+        if method.endswith("+SIMWEIGHT"):
+            w_ij = w_ij * np.array([word_weights[token_corpus.vocab[w]] for w in words])
+        results[:, d] = np.bincount(docs, weights=w_ij, minlength=n_doc)
+        word_contribution = np.bincount(words, weights=w_ij / document_lengths[docs])
+        for w in np.unique(words):
+            contribution[token_corpus.vocab[w]] += word_contribution[w]
+    results[:, -1] = document_lengths
+    # normalize the length of tf-idf vector
+    if normalize:
+        results[:, : len(dimensions)] = preprocessing.normalize(results[:, : len(dimensions)])
+    df = pd.DataFrame(results, columns=dimensions + ["document_length"])
+    df["Doc_ID"] = list(token_corpus.doc_ids)
+    return df, contribution
+
+
 def compute_word_sim_weights(file_name):
     """Compute word weights in each dimension.
     Default weight is 1/ln(1+rank). For example, 1st word in each dim has weight 1.44,
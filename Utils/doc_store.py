@@ -0,0 +1,169 @@
+"""
+Module: utils/doc_store.py
+Description: Sharded storage of parsed spaCy Docs in DocBin files, so that the lemma/NER/POS text variants of a
+parsed corpus can be rendered again from the stored annotations without running the spaCy pipeline.
+
+Each shard holds the Docs of consecutive documents (lines of the parsed input) and is named by the line number of its
+first document, e.g. 000000012000.spacy, so that the shards sorted by name are in input order.
+The index file (shards.json) records the number of documents of each shard and, once the parse is complete,
+the number of documents of the corpus, so that shards left by an earlier run are never read.
+"""
+
+import json
+import os
+from pathlib import Path
+
+from spacy.tokens import DocBin
+from spacy.vocab import Vocab
+
+from Utils.parser import SpacyParser
+
+# Token annotations kept in the shards: enough for the sentences, the lemmas, the entities and the POS tags.
+DOC_ATTRS = ["ORTH", "LEMMA", "POS", "ENT_IOB", "ENT_TYPE", "SENT_START"]
+SHARD_SUFFIX = ".spacy"
+INDEX_FILE = "shards.json"
+# Components whose annotations are stored, see SpacyParser(features=...).
+STORED_FEATURES = ("lemma", "ner", "pos")
+
+
+def shard_path(docbin_dir, first_line):
+    """
+    Args:
+        docbin_dir (str or Path): Folder of the shards.
+        first_line (int): Line number of the first document of the shard.
+
+    Returns:
+        Path: The shard file.
+    """
+    return Path(docbin_dir, f"{first_line:012d}{SHARD_SUFFIX}")
+
+
+def write_shard(docs, docbin_dir, first_line):
+    """
+    Serialize the Docs of consecutive documents into a shard.
+
+    Args:
+        docs (list of Doc): Parsed documents, one per input line.
+        docbin_dir (str or Path): Folder of the shards, created if it does not exist.
+        first_line (int): Line number of the first document.
+    """
+    Path(docbin_dir).mkdir(parents=True, exist_ok=True)
+    doc_bin = DocBin(attrs=DOC_ATTRS, docs=docs)
+    path = shard_path(docbin_dir, first_line)
+    # write then rename, so that an interrupted run does not leave a truncated shard
+    tmp_path = path.with_suffix(".tmp")
+    doc_bin.to_disk(tmp_path)
+    tmp_path.replace(path)
+    index = read_index(docbin_dir)
+    index["shards"][str(first_line)] = len(docs)
+    index["n_documents"] = None
+    _write_index(docbin_dir, index)
+
+
+def read_index(docbin_dir):
+    """
+    Args:
+        docbin_dir (str or Path): Folder of the shards.
+
+    Returns:
+        dict: {"shards": {first line (str): number of documents}, "n_documents": number of documents of the corpus,
+            None until the parse is complete (see finalize_shards)}.
+    """
+    try:
+        with open(Path(docbin_dir, INDEX_FILE), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"shards": {}, "n_documents": None}
+
+
+def _write_index(docbin_dir, index):
+    """Atomically replace the index file of the shards"""
+    path = Path(docbin_dir, INDEX_FILE)
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(index, f)
+    os.replace(tmp_path, path)
+
+
+def clear_shards(docbin_dir):
+    """
+    Remove the shards and the index of a folder, before a parse that does not resume.
+
+    Args:
+        docbin_dir (str or Path): Folder of the shards.
+    """
+    for a_shard in Path(docbin_dir).glob("*" + SHARD_SUFFIX):
+        a_shard.unlink()
+    Path(docbin_dir, INDEX_FILE).unlink(missing_ok=True)
+
+
+def finalize_shards(docbin_dir, n_documents):
+    """
+    Keep the shards that cover the documents 0, 1, ..., n_documents - 1 one after the other, and remove the others
+    (e.g. left by an earlier run with other chunk boundaries), once the parse is complete.
+
+    Args:
+        docbin_dir (str or Path): Folder of the shards.
+        n_documents (int): Number of documents of the parsed corpus.
+    """
+    index = read_index(docbin_dir)
+    shards = {}
+    first_line = 0
+    while first_line < n_documents:
+        n_docs = index["shards"].get(str(first_line))
+        if not n_docs:
+            raise ValueError("The shards of {} do not cover line {}.".format(docbin_dir, first_line))
+        shards[str(first_line)] = n_docs
+        first_line += n_docs
+    kept = {shard_path(docbin_dir, int(k)).name for k in shards}
+    for a_shard in Path(docbin_dir).glob("*" + SHARD_SUFFIX):
+        if a_shard.name not in kept:
+            a_shard.unlink()
+    _write_index(docbin_dir, {"shards": shards, "n_documents": n_documents})
+
+
+def shard_files(docbin_dir):
+    """
+    Args:
+        docbin_dir (str or Path): Folder of the shards of a complete parse (see finalize_shards).
+
+    Returns:
+        list of Path: The shard files of the index in input order.
+    """
+    index = read_index(docbin_dir)
+    if index["n_documents"] is None:
+        raise ValueError("The parse stored in {} is not complete, run parse_document again.".format(docbin_dir))
+    return sorted(shard_path(docbin_dir, int(k)) for k in index["shards"])
+
+
+def read_shard(a_shard):
+    """
+    Args:
+        a_shard (str or Path): A shard file.
+
+    Returns:
+        (int, list of Doc): Line number of the first document and the Docs of the shard.
+    """
+    docs = list(DocBin().from_disk(a_shard).get_docs(Vocab()))
+    return int(Path(a_shard).stem), docs
+
+
+def render_shard(a_shard, lemma=False, ner=False, pos=False):
+    """
+    Render the sentences of the documents of a shard, as SpacyParser.sentence_split(single_pass=True).
+
+    Args:
+        a_shard (str or Path): A shard file.
+        lemma (bool): Use the lemmas.
+        ner (bool): Apply NER formatting.
+        pos (bool): Append POS tags.
+
+    Returns:
+        (int, list): Line number of the first document, and for each document its list of
+            (sentence_id, processed_sentence) tuples.
+    """
+    first_line, docs = read_shard(a_shard)
+    return first_line, [
+        [(idx, SpacyParser.render_sentence(sent, lemma=lemma, ner=ner, pos=pos)) for idx, sent in enumerate(doc.sents)]
+        for doc in docs
+    ]
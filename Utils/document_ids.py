@@ -0,0 +1,135 @@
+"""
+Module: utils/document_ids.py
+Description: Compact document and sentence IDs. Document IDs are read from the ID file through its
+line-offset index instead of being loaded as a list of strings, and sentence IDs are stored as two
+integer columns: the index of the document (line number in the document ID file) and the index of the
+sentence in the document.
+"""
+
+import mmap
+
+import numpy as np
+import pandas as pd
+
+from Utils import file_process
+
+
+class DocumentIds:
+    """
+    A read-only sequence of document IDs backed by the ID file (one ID per line) and its line-offset index.
+    Only the uint64 offsets are in memory, an ID is decoded when it is accessed.
+    A compressed ID file cannot be memory-mapped, it is decompressed in memory and indexed there.
+    """
+
+    def __init__(self, id_file):
+        """
+        Args:
+            id_file (str or Path): Document ID file, each line is an ID (can be compressed).
+        """
+        self.id_file = id_file
+        self._file = None
+        self._mm = None
+        if file_process.is_compressed(id_file):
+            with file_process.open_file(id_file, "rb") as f:
+                self._mm = f.read()
+            line_ends = np.flatnonzero(np.frombuffer(self._mm, dtype=np.uint8) == 10).astype(np.uint64) + 1
+            self.offsets = np.concatenate([np.zeros(1, dtype=np.uint64), line_ends])
+            if self._mm and not self._mm.endswith(b"\n"):
+                # the last line has no line break
+                self.offsets = np.append(self.offsets, np.uint64(len(self._mm)))
+            return
+        self.offsets = file_process.load_line_index(id_file, build=True)
+        self._file = open(id_file, "rb")
+        if len(self.offsets) > 1:
+            self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        """
+        Args:
+            i (int): Index of the document (line number in the ID file).
+
+        Returns:
+            str: The document ID.
+        """
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("document index out of range")
+        start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+        return self._mm[start:end].decode("utf-8").strip()
+
+    def __iter__(self):
+        """Stream the IDs from the file."""
+        with file_process.open_file(self.id_file, "rb") as f:
+            for line in f:
+                yield line.decode("utf-8").strip()
+
+    def __getstate__(self):
+        return {"id_file": self.id_file}
+
+    def __setstate__(self, state):
+        self.__init__(state["id_file"])
+
+    def close(self):
+        if isinstance(self._mm, mmap.mmap):
+            self._mm.close()
+        if self._file is not None:
+            self._file.close()
+
+
+def format_sentence_id(doc_index, sent_index):
+    """
+    Format a sentence ID as a line of two integer columns.
+
+    Args:
+        doc_index (int): Index of the document in the document ID file.
+        sent_index (int): Index of the sentence in the document.
+
+    Returns:
+        str: "doc_index<TAB>sent_index"
+    """
+    return f"{doc_index}\t{sent_index}"
+
+
+def is_int_sentence_id_file(sent_id_file):
+    """
+    Detect the format of a sentence ID file from its first non-blank line: two integer columns written with
+    format_sentence_id, or docID_sentenceID. Only the integer format has blank lines (documents without any
+    sentence), so a file of blank lines is in the integer format.
+
+    Args:
+        sent_id_file (str or Path): Sentence ID file (can be compressed).
+
+    Returns:
+        bool: True for two integer columns, False for docID_sentenceID (or an empty file).
+    """
+    has_blank_lines = False
+    with file_process.open_file(sent_id_file, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                return "\t" in line
+            has_blank_lines = True
+    return has_blank_lines
+
+
+def read_sentence_ids(sent_id_file):
+    """
+    Read a sentence ID file written with format_sentence_id.
+
+    Args:
+        sent_id_file (str or Path): Sentence ID file, each line is "doc_index<TAB>sent_index".
+
+    Returns:
+        (numpy.ndarray, numpy.ndarray): int64 arrays of document indices and sentence indices,
+            -1 for blank lines (documents without any sentence).
+    """
+    if file_process.line_counter(sent_id_file) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    columns = pd.read_csv(
+        sent_id_file, sep="\t", header=None, names=["doc", "sent"], skip_blank_lines=False
+    )
+    columns = columns.fillna(-1).astype(np.int64)
+    return columns["doc"].to_numpy(), columns["sent"].to_numpy()
@@ -1,17 +1,271 @@
 import datetime
+import gzip
+import hashlib
+import io
 import itertools
+import lzma
+import mmap
 import os
 import sys
 from multiprocessing import Pool, freeze_support
 from pathlib import Path
 import json
+import queue
+import threading
+import time
 
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
 
+# compressed corpus files, the compression is chosen by the file extension
+COMPRESSED_SUFFIXES = (".gz", ".xz", ".zst")
+
+
+def is_compressed(a_file):
+    """Whether a file is compressed, based on its extension (.gz, .xz or .zst)"""
+    return Path(str(a_file)).suffix in COMPRESSED_SUFFIXES
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("Reading or writing .zst files requires the zstandard package: pip install zstandard")
+    return zstandard
+
+
+def open_file(a_file, mode="r", encoding=None, errors=None, newline=None, buffering=-1):
+    """Open a plain or compressed file, the compression is chosen by the extension:
+    .gz (gzip), .xz (lzma), .zst (zstandard, compressed with all cores), anything else is a plain file.
+    Usage is the same as the built-in open().
+
+    Arguments:
+        a_file {str or Path} -- path to the file
+
+    Keyword Arguments:
+        mode {str} -- "r", "w", "a", add "b" for binary mode (default: {"r"})
+        encoding, errors, newline -- as in open(), text mode only
+        buffering {int} -- as in open(), plain files only (default: {-1})
+
+    Returns:
+        file object
+    """
+    suffix = Path(str(a_file)).suffix
+    if suffix not in COMPRESSED_SUFFIXES:
+        if "b" in mode:
+            return open(a_file, mode, buffering)
+        return open(a_file, mode, buffering, encoding=encoding, errors=errors, newline=newline)
+    binary_mode = mode if "b" in mode else mode.replace("t", "") + "b"
+    if suffix == ".gz":
+        f = gzip.open(a_file, binary_mode)
+    elif suffix == ".xz":
+        f = lzma.open(a_file, binary_mode)
+    else:
+        zstandard = _zstandard()
+        raw = open(a_file, binary_mode)
+        if "r" in binary_mode:
+            # a file written by process_large_file has one frame per chunk
+            f = io.BufferedReader(
+                zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True, closefd=True)
+            )
+        else:
+            f = zstandard.ZstdCompressor(threads=-1).stream_writer(raw, closefd=True)
+    if "b" in mode:
+        return f
+    return io.TextIOWrapper(f, encoding=encoding, errors=errors, newline=newline)
+
+
+def _compressed_member(raw, suffix):
+    """A binary writer that compresses to one complete gzip member / xz stream / zstd frame
+    on an open raw file. Closing the writer finishes the member but does not close the raw file,
+    so that a file can be truncated after any member and still be read.
+    """
+    if suffix == ".gz":
+        return gzip.GzipFile(fileobj=raw, mode="wb")
+    if suffix == ".xz":
+        return lzma.LZMAFile(raw, mode="wb")
+    zstandard = _zstandard()
+    return zstandard.ZstdCompressor(threads=-1).stream_writer(raw, closefd=False)
+
+
+class LineSentences:
+    """Iterate over a plain or compressed corpus file, or over the files of a folder in file name order,
+    each line is a sentence yielded as a list of tokens.
+    A drop-in replacement of gensim.models.word2vec.PathLineSentences,
+    which can be iterated several times (e.g. by gensim models).
+    """
+
+    def __init__(self, a_file, max_sentence_length=10000000, byte_range=None):
+        """
+        Arguments:
+            a_file {str or Path} -- corpus file, the compression is chosen by the extension (see open_file),
+                or a folder of corpus files
+
+        Keyword Arguments:
+            max_sentence_length {int} -- longer lines are split into several sentences (default: {10000000})
+            byte_range {(int, int)} -- only iterate over the lines in [start, end) bytes, both at line starts
+                (e.g. from the line-offset index), plain files only (default: {None})
+        """
+        if byte_range is not None and Path(a_file).is_dir():
+            raise ValueError("byte_range requires a corpus file, {} is a folder.".format(a_file))
+        self.a_file = a_file
+        self.max_sentence_length = max_sentence_length
+        self.byte_range = byte_range
+
+    def _files(self):
+        """The corpus file, or the files of the folder sorted by name as PathLineSentences does"""
+        if Path(self.a_file).is_dir():
+            return sorted(f for f in Path(self.a_file).iterdir() if f.is_file())
+        return [self.a_file]
+
+    def _lines(self):
+        if self.byte_range is None:
+            for a_file in self._files():
+                with open_file(a_file, encoding="utf-8") as f:
+                    yield from f
+            return
+        start, end = self.byte_range
+        with open(self.a_file, "rb") as f:
+            f.seek(start)
+            position = start
+            while position < end:
+                line = f.readline()
+                if not line:
+                    break
+                position += len(line)
+                yield line.decode("utf-8")
+
+    def __iter__(self):
+        for line in self._lines():
+            tokens = line.split()
+            for i in range(0, len(tokens), self.max_sentence_length):
+                yield tokens[i: i + self.max_sentence_length]
+
+
+def byte_range_shards(a_file, n_shards):
+    """Split a plain text file into byte ranges of about the same size that start and end at line starts
+
+    Arguments:
+        a_file {str or Path} -- text file, its line-offset index is built if needed
+        n_shards {int} -- number of shards
+
+    Returns:
+        [(int, int)] -- (start, end) byte ranges, without empty ranges; None for a compressed file or a folder
+    """
+    if Path(a_file).is_dir():
+        return None
+    offsets = load_line_index(a_file, build=True)
+    if offsets is None:
+        return None
+    size = int(offsets[-1])
+    bounds = [int(offsets[np.searchsorted(offsets, size * k // n_shards)]) for k in range(n_shards)] + [size]
+    return [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+
+def line_index_path(a_file):
+    """Path of the line-offset index of a text file
+
+    Arguments:
+        a_file {str or Path} -- text file
+
+    Returns:
+        Path -- a_file + ".idx"
+    """
+    return Path(str(a_file) + ".idx")
+
+
+def build_line_index(a_file, block_size=1 << 26):
+    """Build the line-offset index of a text file and save it next to the file.
+    The index is a flat uint64 array with the byte offset of the start of each line,
+    followed by the size of the file, so line i spans offsets[i]:offsets[i + 1]
+    and the number of lines is len(offsets) - 1.
+    Compressed files cannot be indexed.
+
+    Arguments:
+        a_file {str or Path} -- text file, lines are separated by "\n"
+
+    Keyword Arguments:
+        block_size {int} -- number of bytes scanned at once (default: {64MB})
+
+    Returns:
+        numpy.ndarray or None -- the uint64 offsets, None for a compressed file
+    """
+    if is_compressed(a_file):
+        return None
+    size = os.path.getsize(a_file)
+    offsets = [np.zeros(1, dtype=np.uint64)]
+    if size > 0:
+        with open(a_file, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for start in range(0, size, block_size):
+                block = np.frombuffer(mm[start: start + block_size], dtype=np.uint8)
+                offsets.append(np.flatnonzero(block == 10).astype(np.uint64) + (start + 1))
+            last_byte = mm[size - 1]
+        if last_byte != 10:
+            # the last line has no line break
+            offsets.append(np.array([size], dtype=np.uint64))
+    offsets = np.concatenate(offsets)
+    try:
+        offsets.tofile(str(line_index_path(a_file)))
+    except OSError:
+        pass
+    return offsets
+
+
+def load_line_index(a_file, build=False):
+    """Memory-map the line-offset index of a text file.
+    The index is considered up to date if it is not older than the file
+    and its last offset equals the size of the file.
+
+    Arguments:
+        a_file {str or Path} -- text file
+
+    Keyword Arguments:
+        build {bool} -- build the index if it is missing or outdated (default: {False})
+
+    Returns:
+        numpy.ndarray or None -- the uint64 offsets, None if there is no up to date index and build is False
+    """
+    if is_compressed(a_file):
+        return None if not build else build_line_index(a_file)
+    index_path = line_index_path(a_file)
+    try:
+        if os.path.getmtime(index_path) >= os.path.getmtime(a_file):
+            offsets = np.memmap(index_path, dtype=np.uint64, mode="r")
+            if int(offsets[-1]) == os.path.getsize(a_file):
+                return offsets
+    except (OSError, ValueError):
+        pass
+    if build:
+        return build_line_index(a_file)
+    return None
+
+
+def read_line(a_file, line_number, offsets=None):
+    """Read a single line of a text file in O(1) using its line-offset index (plain text files only)
+
+    Arguments:
+        a_file {str or Path} -- text file
+        line_number {int} -- index of the line (starts with 0)
+
+    Keyword Arguments:
+        offsets {numpy.ndarray} -- offsets from load_line_index, loaded (or built) if None (default: {None})
+
+    Returns:
+        str -- the line without the line break
+    """
+    if offsets is None:
+        offsets = load_line_index(a_file, build=True)
+    start, end = int(offsets[line_number]), int(offsets[line_number + 1])
+    with open(a_file, "rb") as f:
+        f.seek(start)
+        return f.read(end - start).decode("utf-8").rstrip("\n")
+
+
 def line_counter(a_file):
-    """Count the number of lines in a text file
+    """Count the number of lines in a text file.
+    Uses the line-offset index of the file if it is up to date, otherwise scans the file.
 
     Arguments:
         a_file {str or Path} -- input text file
@@ -19,8 +273,11 @@ def line_counter(a_file):
     Returns:
         int -- number of lines in the file
     """
+    offsets = load_line_index(a_file)
+    if offsets is not None:
+        return len(offsets) - 1
     n_lines = 0
-    with open(a_file, "rb") as f:
+    with open_file(a_file, "rb") as f:
         n_lines = sum(1 for _ in f)
     return n_lines
 
@@ -35,7 +292,7 @@ def file_to_list(a_file):
         [str] -- list of lines in the input file, can be empty
     """
     file_content = []
-    with open(a_file, "rb") as f:
+    with open_file(a_file, "rb") as f:
         for l in f:
             file_content.append(l.decode(encoding="utf-8").strip())
     return file_content
@@ -49,10 +306,11 @@ def list_to_file(lst, a_file, validate=True):
         validate {bool} -- check if number of lines in the file
             equals to the length of the list (default: {True})
     """
-    with open(a_file, "w", 8192000, encoding="utf-8", newline="\n") as f:
+    with open_file(a_file, "w", encoding="utf-8", newline="\n", buffering=8192000) as f:
         for e in lst:
             e = str(e).replace("\n", " ").replace("\r", " ")
             f.write("{}\n".format(e))
+    build_line_index(a_file)
     if validate:
         assert line_counter(a_file) == len(lst)
 
@@ -70,7 +328,7 @@ def read_large_file(a_file, block_size=10000):
         block_size {int} -- [number of lines in a block] (default: {10000})
     """
     block = []
-    with open(a_file) as file_handler:
+    with open_file(a_file) as file_handler:
         for line in file_handler:
             block.append(line)
             if len(block) == block_size:
@@ -117,74 +375,503 @@ def merge_fields_and_contents(field_file, content_file, output_field_file, outpu
             f_output_contents.write(content + '\n')
 
 
+def manifest_path(output_file):
+    """Path of the checkpoint manifest written next to an output file by process_large_file
+
+    Arguments:
+        output_file {str or Path} -- output file of a stage
+
+    Returns:
+        Path -- output_file + ".manifest.json"
+    """
+    return Path(str(output_file) + ".manifest.json")
+
+
+def params_hash(params):
+    """Hash the parameters of a stage, so that a checkpoint is only resumed with the same parameters
+
+    Arguments:
+        params {dict} -- json serializable stage parameters, sets are sorted before hashing
+
+    Returns:
+        str -- sha1 hex digest
+    """
+
+    def _default(o):
+        if isinstance(o, (set, frozenset)):
+            return sorted(o)
+        return str(o)
+
+    serialized = json.dumps(params, sort_keys=True, default=_default)
+    return hashlib.sha1(serialized.encode("utf-8")).hexdigest()
+
+
+def read_manifest(output_file):
+    """Read the checkpoint manifest of an output file
+
+    Returns:
+        dict or None -- the manifest, None if it does not exist or cannot be read
+    """
+    try:
+        with open(manifest_path(output_file), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_manifest(output_file, manifest, durable=True):
+    """Atomically replace the checkpoint manifest of an output file, synced to the disk if durable"""
+    path = manifest_path(output_file)
+    tmp_path = Path(str(path) + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+        f.flush()
+        if durable:
+            os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _file_size(a_file):
+    """Size of a file in bytes, 0 if a_file is None or does not exist"""
+    if a_file is None:
+        return 0
+    try:
+        return os.path.getsize(a_file)
+    except OSError:
+        return 0
+
+
+def _truncate(a_file, size):
+    """Truncate a file to size bytes, return False if the file is shorter than size"""
+    if a_file is None:
+        return True
+    if _file_size(a_file) < size:
+        return False
+    with open(a_file, "r+b") as f:
+        f.truncate(size)
+    return True
+
+
+def _resume_point(output_file, output_index_file, stage_hash):
+    """Find where to resume a stage from its checkpoint manifest, and truncate the outputs
+    to the last completely flushed chunk.
+
+    Returns:
+        int or None -- input line to start from, None to start from scratch
+    """
+    manifest = read_manifest(output_file)
+    if manifest is None:
+        print("No checkpoint found for {}, starting from the first line.".format(output_file))
+        return None
+    if manifest.get("params_hash") != stage_hash:
+        print("Checkpoint of {} was written with different parameters, starting from the first line.".format(output_file))
+        return None
+    if not (
+        _truncate(output_file, manifest["output_bytes"])
+        and _truncate(output_index_file, manifest["index_bytes"])
+    ):
+        print("Output files of {} are shorter than the checkpoint, starting from the first line.".format(output_file))
+        return None
+    print("Resuming {} from line {}.".format(output_file, manifest["input_line"]))
+    return manifest["input_line"]
+
+
+# line function of a process_large_file worker process, built once by _init_worker
+_worker_function = None
+_worker_batched = False
+
+
+def _init_worker(function_factory, batched=False):
+    """Build the line function once in each worker process of process_large_file
+
+    Arguments:
+        function_factory {callable} -- a picklable callable that returns the line function
+        batched {bool} -- the function processes a list of lines and a list of ids at once
+    """
+    global _worker_function, _worker_batched
+    _worker_function = function_factory()
+    _worker_batched = batched
+
+
+def _apply_function(function, batched, lines, line_ids):
+    """Apply a line function (or a batch function) to a chunk of lines
+
+    Returns:
+        [str], [str] -- processed lines and processed line ids, in input order
+    """
+    if batched:
+        output_lines, output_line_ids = function(lines, line_ids)
+        return list(output_lines), list(output_line_ids)
+    output_lines = []
+    output_line_ids = []
+    for output_line, output_line_id in map(function, lines, line_ids):
+        output_lines.append(output_line)
+        output_line_ids.append(output_line_id)
+    return output_lines, output_line_ids
+
+
+def _process_chunk(lines_and_ids):
+    """Apply the line function built by _init_worker to a sub-chunk of lines
+
+    Arguments:
+        lines_and_ids {([str], [str])} -- a tuple of lines and the corresponding line ids
+
+    Returns:
+        [str], [str] -- processed lines and processed line ids, in input order
+    """
+    lines, line_ids = lines_and_ids
+    return _apply_function(_worker_function, _worker_batched, lines, line_ids)
+
+
+def _split_chunk(lines, line_ids, n_parts):
+    """Split a chunk of lines and ids into at most n_parts contiguous sub-chunks
+
+    Returns:
+        [([str], [str])] -- a list of (lines, line ids) tuples, concatenating them gives back the chunk
+    """
+    size = -(-len(lines) // n_parts)  # ceiling division
+    return [
+        (lines[i: i + size], line_ids[i: i + size]) for i in range(0, len(lines), size)
+    ]
+
+
+def _read_chunks(f_in, input_file_ids, chunk_size):
+    """Yield chunks of lines and the corresponding ids from an open input file
+
+    Yields:
+        [str], [str] -- at most chunk_size lines and their ids
+    """
+    for next_n_lines, next_n_line_ids in zip(
+        itertools.zip_longest(*[f_in] * chunk_size),
+        itertools.zip_longest(*[iter(input_file_ids)] * chunk_size),
+    ):
+        next_n_lines = list(filter(lambda x: x is not None, next_n_lines))
+        next_n_line_ids = list(filter(lambda x: x is not None, next_n_line_ids))
+        yield next_n_lines, next_n_line_ids
+
+
+class _ChunkWriter:
+    """Append processed chunks to the output files of process_large_file, keeping the file handles open,
+    and write the checkpoint manifest after each chunk is on disk.
+    A compressed output gets one complete compressed member per chunk, so that it can be truncated
+    after any chunk when resuming.
+    The chunks are flushed to the OS, which is enough to resume after the process crashes; with durable,
+    they are also synced to the disk (os.fsync) before the manifest, to resume after a system crash.
+    """
+
+    def __init__(self, output_file, output_index_file, stage_hash, durable=False):
+        self.output_file = output_file
+        self.output_index_file = output_index_file
+        self.stage_hash = stage_hash
+        self.durable = durable
+        self.f_out = open(output_file, "ab")
+        self.f_index = None
+        if output_index_file is not None:
+            self.f_index = open(output_index_file, "ab")
+
+    @staticmethod
+    def _write_lines(f, a_file, lines, durable=False):
+        suffix = Path(str(a_file)).suffix
+        if suffix in COMPRESSED_SUFFIXES:
+            writer = _compressed_member(f, suffix)
+        else:
+            writer = f
+        f_text = io.TextIOWrapper(writer, encoding="utf-8", newline="\n")
+        # write line by line instead of joining the chunk into one large string
+        for line in lines:
+            f_text.write(line)
+            f_text.write("\n")
+        f_text.flush()
+        # detach, so that the file is not closed with the wrapper
+        f_text.detach()
+        if writer is not f:
+            writer.close()
+        f.flush()
+        if durable:
+            os.fsync(f.fileno())
+
+    def write(self, output_lines, output_line_ids, line_i):
+        """Write a processed chunk, line_i is the input line following the chunk"""
+        self._write_lines(self.f_out, self.output_file, output_lines, self.durable)
+        if self.f_index is not None:
+            self._write_lines(self.f_index, self.output_index_file, output_line_ids, self.durable)
+        # checkpoint after the chunk is on disk
+        _write_manifest(
+            self.output_file,
+            {
+                "params_hash": self.stage_hash,
+                "input_line": line_i,
+                "output_bytes": self.f_out.tell(),
+                "index_bytes": self.f_index.tell() if self.f_index is not None else 0,
+            },
+            durable=self.durable,
+        )
+
+    def close(self):
+        self.f_out.close()
+        if self.f_index is not None:
+            self.f_index.close()
+
+
+class _StageTimer:
+    """Busy time and number of lines of a stage in the pipeline of process_large_file"""
+
+    def __init__(self, name):
+        self.name = name
+        self.busy = 0.0
+        self.n_lines = 0
+
+    def add(self, seconds, n_lines):
+        self.busy += seconds
+        self.n_lines += n_lines
+
+    def report(self, wall):
+        rate = self.n_lines / self.busy if self.busy > 0 else float("inf")
+        print(
+            "{}: {} lines, busy {:.1f}s of {:.1f}s ({:.0f} lines/s).".format(
+                self.name, self.n_lines, self.busy, wall, rate
+            )
+        )
+
+
+def _put(a_queue, item, stop):
+    """Put an item in a bounded queue, give up if the stop event is set"""
+    while not stop.is_set():
+        try:
+            a_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
 def process_large_file(
     input_file,
     output_file,
     input_file_ids,
     output_index_file,
-    function_name,
+    function_name=None,
     chunk_size=100,
     start_index=None,
+    workers=1,
+    function_factory=None,
+    resume=False,
+    params=None,
+    pipeline=False,
+    queue_size=2,
+    batched=False,
+    durable=False,
 ):
     """ A helper function that transforms an input file + a list of IDs of each line (documents + document_IDs) to two output files (processed documents + processed document IDs) by calling function_name on chunks of the input files. Each document can be decomposed into multiple processed documents (e.g. sentences).
-    Supports parallel with Pool.
+    Supports parallel with Pool: with workers > 1, each chunk is split into contiguous sub-chunks that are processed by a pool of processes, and the results are written back in input order.
+    After every flushed chunk, a checkpoint manifest (output_file + ".manifest.json") records the next input line,
+    the byte sizes of the output files and a hash of the stage parameters, so that a crashed run can continue with resume=True.
+    With pipeline=True, a reader thread, the compute stage and a writer thread are connected by bounded queues,
+    so that reading, processing and writing overlap; the throughput of each stage is printed at the end.
 
     Arguments:
         input_file {str or Path} -- path to a text file, each line is a document
         output_file {str or Path} -- processed line sentence file (remove if exists)
-        input_file_ids {str]} -- a list of input line ids
+        input_file_ids {[str] or None} -- input line ids: a list, or any sized iterable (e.g. document_ids.DocumentIds),
+            None to use the line numbers 0, 1, ... as ids
         output_index_file {str or Path} -- path to the index file of the output
-        function_name {callable} -- A function that processes a list of strings, list of ids and return a list of processed strings and ids.
+        function_name {callable} -- A function that processes a line and its id and returns a processed line and id.
         chunk_size {int} -- number of lines to process each time, increasing the default may increase performance
         start_index {int} -- line number to start from (index starts with 0)
+        workers {int} -- number of processes to use (default: {1}, i.e. no Pool)
+        function_factory {callable} -- a picklable callable without arguments that returns function_name.
+            Required if workers > 1, it is called once in each worker so that expensive objects
+            (e.g. TextCleaner, SpacyParser) are built once per process instead of being pickled with every chunk.
+        resume {bool} -- continue from the checkpoint manifest of output_file if it was written with the same params,
+            truncating any partially written chunk; start from scratch otherwise (default: {False})
+        params {dict} -- json serializable parameters of the stage, hashed into the manifest (default: {None})
+        pipeline {bool} -- overlap reading, processing and writing using threads and bounded queues (default: {False})
+        queue_size {int} -- max number of chunks waiting in each queue of the pipeline, bounds the memory (default: {2})
+        batched {bool} -- function_name processes a list of lines and a list of ids at once and returns
+            a list of processed lines and a list of processed ids, to amortize per-call overhead (default: {False})
+        durable {bool} -- sync each chunk and its checkpoint to the disk (os.fsync), so that resume also works
+            after a system crash; otherwise the chunks are only flushed, which covers a crash of the process
+            and avoids a sync per chunk (default: {False})
 
     Writes:
-        Write the output_file and output_index_file
+        Write the output_file and output_index_file, and the checkpoint manifest of output_file
     """
-    try:
-        if start_index is None:
-            # if start from the first line, remove existing output file
-            # else append to existing output file
-            os.remove(str(output_file))
-            if output_index_file is not None:
-                os.remove(str(output_index_file))
-    except OSError:
-        pass
-    assert line_counter(input_file) == len(
+    if function_name is None and function_factory is None:
+        raise ValueError("Either function_name or function_factory must be provided.")
+    if workers > 1 and function_factory is None:
+        raise ValueError("function_factory is required when workers > 1.")
+    if resume and start_index is not None:
+        raise ValueError("start_index cannot be used together with resume.")
+    n_lines = line_counter(input_file)
+    if input_file_ids is None:
+        input_file_ids = range(n_lines)
+    assert n_lines == len(
         input_file_ids
     ), "Make sure the input file has the same number of rows as the input ID file. "
+    stage_hash = params_hash(
+        {"input_file": str(input_file), "n_lines": n_lines, "params": params}
+    )
 
-    with open(input_file, newline="\n", encoding="utf-8", errors="ignore") as f_in:
-        line_i = 0
-        # jump to index
-        if start_index is not None:
-            # start at start_index line
-            for _ in range(start_index):
-                next(f_in)
-            input_file_ids = input_file_ids[start_index:]
-            line_i = start_index
-        for next_n_lines, next_n_line_ids in zip(
-            itertools.zip_longest(*[f_in] * chunk_size),
-            itertools.zip_longest(*[iter(input_file_ids)] * chunk_size),
-        ):
-            line_i += chunk_size
-            print(datetime.datetime.now())
-            print(f"Processing line: {line_i}.")
-            next_n_lines = list(filter(lambda x: x is not None, next_n_lines))
-            next_n_line_ids = list(filter(lambda x: x is not None, next_n_line_ids))
-            output_lines = []
-            output_line_ids = []
-            # Use parse_parallel.py to speed things up
-            for output_line, output_line_id in map(
-                function_name, next_n_lines, next_n_line_ids
+    if resume:
+        start_index = _resume_point(output_file, output_index_file, stage_hash)
+        if start_index is not None and start_index >= n_lines:
+            print("{} is already complete.".format(output_file))
+            return
+    if start_index is None:
+        # if start from the first line, remove existing output file
+        # else append to existing output file
+        for a_file in (output_file, output_index_file):
+            try:
+                if a_file is not None:
+                    os.remove(str(a_file))
+            except OSError:
+                pass
+
+    pool = None
+    if workers > 1:
+        pool = Pool(workers, initializer=_init_worker, initargs=(function_factory, batched))
+    elif function_name is None:
+        function_name = function_factory()
+
+    def compute(next_n_lines, next_n_line_ids):
+        output_lines = []
+        output_line_ids = []
+        if pool is not None:
+            # Pool.map returns the sub-chunks in order, so the output keeps the input order
+            for sub_lines, sub_line_ids in pool.map(
+                _process_chunk, _split_chunk(next_n_lines, next_n_line_ids, workers)
             ):
-                output_lines.append(output_line)
-                output_line_ids.append(output_line_id)
-            output_lines = "\n".join(output_lines) + "\n"
-            output_line_ids = "\n".join(output_line_ids) + "\n"
-            with open(output_file, "a", newline="\n", encoding="utf-8") as f_out:
-                f_out.write(output_lines)
-            if output_index_file is not None:
-                with open(output_index_file, "a", newline="\n") as f_out:
-                    f_out.write(output_line_ids)
+                output_lines.extend(sub_lines)
+                output_line_ids.extend(sub_line_ids)
+        else:
+            output_lines, output_line_ids = _apply_function(
+                function_name, batched, next_n_lines, next_n_line_ids
+            )
+        return output_lines, output_line_ids
 
+    writer = None
+    try:
+        with open_file(input_file, newline="\n", encoding="utf-8", errors="ignore") as f_in:
+            line_i = 0
+            # jump to index
+            if start_index is not None:
+                # start at start_index line, seek directly if the input has a line index
+                input_offsets = load_line_index(input_file)
+                if input_offsets is not None:
+                    f_in.seek(int(input_offsets[start_index]))
+                else:
+                    for _ in range(start_index):
+                        next(f_in)
+                input_file_ids = itertools.islice(input_file_ids, start_index, None)
+                line_i = start_index
+            writer = _ChunkWriter(output_file, output_index_file, stage_hash, durable=durable)
+            chunks = _read_chunks(f_in, input_file_ids, chunk_size)
+            if pipeline:
+                _run_pipeline(chunks, compute, writer, line_i, queue_size)
+            else:
+                for next_n_lines, next_n_line_ids in chunks:
+                    print(datetime.datetime.now())
+                    print(f"Processing line: {line_i + chunk_size}.")
+                    line_i += len(next_n_lines)
+                    output_lines, output_line_ids = compute(next_n_lines, next_n_line_ids)
+                    writer.write(output_lines, output_line_ids, line_i)
+    finally:
+        if writer is not None:
+            writer.close()
+        if pool is not None:
+            pool.close()
+            pool.join()
+    build_line_index(output_file)
+    if output_index_file is not None:
+        build_line_index(output_index_file)
+
+
+def _run_pipeline(chunks, compute, writer, line_i, queue_size):
+    """Run the reader, compute and writer stages of process_large_file concurrently.
+    The reader and the writer are threads, compute runs in the calling thread (and in the Pool if any).
+    Bounded queues between the stages provide backpressure.
+
+    Arguments:
+        chunks {iterator} -- yields (lines, line ids) chunks read from the input file
+        compute {callable} -- processes a chunk, returns (output lines, output line ids)
+        writer {_ChunkWriter} -- writes the processed chunks
+        line_i {int} -- input line of the first chunk
+        queue_size {int} -- max number of chunks in each queue
+    """
+    read_queue = queue.Queue(maxsize=queue_size)
+    write_queue = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    errors = []
+    timers = [_StageTimer("read"), _StageTimer("compute"), _StageTimer("write")]
+    done = object()
+
+    def read():
+        try:
+            while True:
+                t = time.perf_counter()
+                chunk = next(chunks, done)
+                if chunk is done:
+                    break
+                timers[0].add(time.perf_counter() - t, len(chunk[0]))
+                if not _put(read_queue, chunk, stop):
+                    return
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        _put(read_queue, done, stop)
+
+    def write():
+        try:
+            while True:
+                try:
+                    item = write_queue.get(timeout=0.1)
+                except queue.Empty:
+                    if stop.is_set():
+                        return
+                    continue
+                if item is done:
+                    return
+                output_lines, output_line_ids, next_line_i, n_lines = item
+                t = time.perf_counter()
+                writer.write(output_lines, output_line_ids, next_line_i)
+                timers[2].add(time.perf_counter() - t, n_lines)
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+
+    start = time.perf_counter()
+    reader_thread = threading.Thread(target=read, daemon=True)
+    writer_thread = threading.Thread(target=write, daemon=True)
+    reader_thread.start()
+    writer_thread.start()
+    try:
+        while not stop.is_set():
+            try:
+                chunk = read_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if chunk is done:
+                break
+            next_n_lines, next_n_line_ids = chunk
+            print(datetime.datetime.now())
+            print(f"Processing line: {line_i + len(next_n_lines)}.")
+            line_i += len(next_n_lines)
+            t = time.perf_counter()
+            output_lines, output_line_ids = compute(next_n_lines, next_n_line_ids)
+            timers[1].add(time.perf_counter() - t, len(next_n_lines))
+            _put(write_queue, (output_lines, output_line_ids, line_i, len(next_n_lines)), stop)
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        if not stop.is_set():
+            write_queue.put(done)
+        writer_thread.join()
+        # release the reader if it is still waiting on a full queue
+        stop.set()
+        reader_thread.join()
+    if errors:
+        raise errors[0]
+    wall = time.perf_counter() - start
+    for timer in timers:
+        timer.report(wall)
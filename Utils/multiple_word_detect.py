@@ -1,34 +1,138 @@
 import gensim
 import global_options
 import datetime
+import functools
+import multiprocessing
 import tqdm
 import json
 from pathlib import Path
 from Utils import file_process
 
 
-def train_bigram_model(input_path, model_path):
+class PhrasedSentences:
+    """Apply a cascade of phrase tables to the sentences of a corpus on the fly,
+    e.g. to train the trigram model on the bigram sentences without writing the bigram corpus.
+    """
+
+    def __init__(self, sentences, phraser_paths):
+        """
+        Arguments:
+            sentences {iterable of [str]} -- the sentences, e.g. a file_process.LineSentences
+            phraser_paths {[str or Path]} -- frozen phrase tables (see export_frozen_phrases) or phrase models,
+                applied in order; a phrase model is applied with the threshold and scoring it was trained with
+        """
+        self.sentences = sentences
+        self.phrasers = [gensim.models.phrases.Phrases.load(str(p)) for p in phraser_paths]
+
+    def __iter__(self):
+        for sentence in self.sentences:
+            for phraser in self.phrasers:
+                sentence = phraser[sentence]
+            yield sentence
+
+
+def _count_shard(byte_range, input_path, max_vocab_size, connector_words, input_phrases=None):
+    """Count the unigrams and bigrams of a byte range of the corpus with a Phrases model, run in the worker processes.
+    The counts are pruned when the vocab grows over max_vocab_size, as gensim does.
+
+    Returns:
+        int, dict, int -- min_reduce, vocab (word or phrase -> count), number of words
+    """
+    corpus = file_process.LineSentences(input_path, max_sentence_length=10000000, byte_range=byte_range)
+    if input_phrases:
+        corpus = PhrasedSentences(corpus, input_phrases)
+    shard_model = gensim.models.phrases.Phrases(
+        corpus,
+        min_count=global_options.PHRASE_MIN_COUNT,
+        threshold=global_options.PHRASE_THRESHOLD,
+        max_vocab_size=max_vocab_size,
+        connector_words=connector_words,
+    )
+    return shard_model.min_reduce, shard_model.vocab, shard_model.corpus_word_count
+
+
+def _train_sharded(input_path, workers, max_vocab_size, input_phrases=None):
+    """Train a phrase model with the counts of byte-range shards of the corpus counted in parallel
+    and merged as gensim.models.phrases.Phrases.add_vocab does. Without pruning, the merged vocab is the vocab
+    of sequential training, so the model (and its scores, which depend on the vocab size with the default scorer)
+    is the same. Each process counts up to max_vocab_size // workers words and phrases, so that the memory does
+    not grow with workers; a corpus whose vocab does not fit is pruned earlier than in sequential training.
+
+    Returns:
+        gensim.models.phrases.Phrases -- the trained phrase model, None for a compressed corpus
+    """
+    shards = file_process.byte_range_shards(input_path, workers)
+    if shards is None:
+        return None
+    n_processes = min(workers, len(shards))
+    bigram_model = gensim.models.phrases.Phrases(
+        min_count=global_options.PHRASE_MIN_COUNT,
+        scoring="default",
+        threshold=global_options.PHRASE_THRESHOLD,
+        max_vocab_size=max_vocab_size,
+        connector_words=global_options.STOPWORDS,
+    )
+    count = functools.partial(
+        _count_shard,
+        input_path=str(input_path),
+        max_vocab_size=max(max_vocab_size // n_processes, 1),
+        connector_words=frozenset(global_options.STOPWORDS),
+        input_phrases=input_phrases,
+    )
+    with multiprocessing.Pool(n_processes) as pool:
+        for min_reduce, vocab, total_words in tqdm.tqdm(pool.imap_unordered(count, shards), total=len(shards)):
+            bigram_model.corpus_word_count += total_words
+            bigram_model.min_reduce = max(bigram_model.min_reduce, min_reduce)
+            if not bigram_model.vocab:
+                bigram_model.vocab = vocab
+                continue
+            for word, word_count in vocab.items():
+                bigram_model.vocab[word] = bigram_model.vocab.get(word, 0) + word_count
+            if len(bigram_model.vocab) > max_vocab_size:
+                gensim.utils.prune_vocab(bigram_model.vocab, bigram_model.min_reduce)
+                bigram_model.min_reduce += 1
+    return bigram_model
+
+
+def train_bigram_model(input_path, model_path, workers=1, max_vocab_size=40000000, input_phrases=None):
     """ Train a phrase model and save it to the disk.
 
     Arguments:
         input_path {str or Path} -- input corpus
         model_path {str or Path} -- where to save the trained phrase model?
 
+    Keyword Arguments:
+        workers {int} -- if > 1, the corpus is split into byte-range shards counted in parallel and the counts
+            are merged; a compressed corpus or a folder cannot be split and is counted in one process (default: {1})
+        max_vocab_size {int} -- max number of words and phrases counted, the rarest are pruned above it;
+            shared by the processes, each counts up to max_vocab_size // workers (default: {40000000})
+        input_phrases {[str or Path]} -- phrase tables of the previous levels, applied to the input sentences
+            on the fly, e.g. [bigram table] to train the trigram model on the unigram corpus: frozen phrase tables
+            (see export_frozen_phrases, only for models trained on unigrams) or phrase models, applied with
+            the threshold and scoring they were trained with (default: {None})
+
     Returns:
         gensim.models.phrases.Phrases -- the trained phrase model
     """
     Path(model_path).parent.mkdir(parents=True, exist_ok=True)
     print(datetime.datetime.now())
     print("Training phraser...")
-    corpus = gensim.models.word2vec.PathLineSentences(
-        str(input_path), max_sentence_length=10000000
-    )
-    n_lines = file_process.line_counter(input_path)
+    if workers > 1:
+        bigram_model = _train_sharded(input_path, workers, max_vocab_size, input_phrases=input_phrases)
+        if bigram_model is not None:
+            bigram_model.save(str(model_path))
+            return bigram_model
+        print("{} cannot be split (compressed file or folder), counting it in one process.".format(input_path))
+    corpus = file_process.LineSentences(input_path, max_sentence_length=10000000)
+    if input_phrases:
+        corpus = PhrasedSentences(corpus, input_phrases)
+    n_lines = file_process.line_counter(input_path) if not Path(input_path).is_dir() else None
     bigram_model = gensim.models.phrases.Phrases(
         tqdm.tqdm(corpus, total=n_lines),
         min_count=global_options.PHRASE_MIN_COUNT,
         scoring="default",
         threshold=global_options.PHRASE_THRESHOLD,
+        max_vocab_size=max_vocab_size,
         connector_words=global_options.STOPWORDS,
     )
     bigram_model.save(str(model_path))
@@ -46,25 +150,211 @@ def bigram_transform(line, bigram_phraser):
     return " ".join(bigram_phraser[line.split()])
 
 
-def file_bigramer(input_path, output_path, model_path, threshold=None, scoring=None):
+def frozen_model_path(model_path):
+    """Path of the frozen phrase table exported from a phrase model
+
+    Arguments:
+        model_path {str or Path} -- phrase model, e.g. bigram.mod
+
+    Returns:
+        Path -- e.g. bigram_frozen.mod
+    """
+    model_path = Path(model_path)
+    return model_path.with_name(model_path.stem + "_frozen" + model_path.suffix)
+
+
+def load_phrase_model(model_path, threshold=None, scoring=None):
+    """ Load a phrase model (or a frozen phrase table) with another threshold or scoring function
+
+    Arguments:
+        model_path {str or Path} -- phrase model saved by train_bigram_model
+
+    Keyword Arguments:
+        threshold {float} -- threshold of the phrase model, the one it was trained with if None (default: {None})
+        scoring {str} -- name of the scoring function in gensim.models.phrases, the one it was trained with
+            if None (default: {None})
+
+    Returns:
+        gensim.models.phrases.Phrases -- the phrase model
+    """
+    phrase_model = gensim.models.phrases.Phrases.load(str(model_path))
+    if scoring is not None:
+        phrase_model.scoring = getattr(gensim.models.phrases, scoring)
+    if threshold is not None:
+        phrase_model.threshold = threshold
+    return phrase_model
+
+
+def has_phrased_tokens(phrase_model):
+    """ Whether a phrase model was trained on tokens already joined by a phrase model, e.g. the trigram model
+    trained on the bigram sentences. gensim exports the phrases by splitting the vocab keys on the delimiter,
+    which scores a phrase of joined tokens with the counts of other words, so such a model cannot be frozen.
+    The phrases of a model trained on unigrams have connector words only between their first and last words,
+    a vocab key with another word inside contains a joined token.
+
+    Arguments:
+        phrase_model {gensim.models.phrases.Phrases} -- the phrase model
+
+    Returns:
+        bool -- True if the model cannot be frozen
+    """
+    for key in phrase_model.vocab:
+        words = key.split(phrase_model.delimiter)
+        if len(words) > 2 and any(word not in phrase_model.connector_words for word in words[1:-1]):
+            return True
+    return False
+
+
+def freeze_phrases(phrase_model):
+    """ The frozen phrase table of a phrase model, or the model itself if it cannot be frozen
+    (see has_phrased_tokens). Both join the same phrases.
+
+    Arguments:
+        phrase_model {gensim.models.phrases.Phrases} -- the phrase model
+
+    Returns:
+        gensim.models.phrases.FrozenPhrases or gensim.models.phrases.Phrases -- the phraser to apply
+    """
+    if has_phrased_tokens(phrase_model):
+        return phrase_model
+    return phrase_model.freeze()
+
+
+def export_frozen_phrases(model_path, threshold=None, scoring=None):
+    """ Export the frozen phrase table of a phrase model: only the phrases that pass the threshold with the
+    scoring function are kept, which is much smaller and faster to apply than the full model.
+    Only for a model trained on unigrams (see has_phrased_tokens), apply the other models themselves.
+
+    Arguments:
+        model_path {str or Path} -- phrase model saved by train_bigram_model
+
+    Keyword Arguments:
+        threshold {float} -- threshold of the phrase model, the one it was trained with if None (default: {None})
+        scoring {str} -- name of the scoring function in gensim.models.phrases, the one it was trained with
+            if None (default: {None})
+
+    Returns:
+        Path -- the frozen phrase table, see frozen_model_path
+    """
+    bigram_model = load_phrase_model(model_path, threshold=threshold, scoring=scoring)
+    if has_phrased_tokens(bigram_model):
+        raise ValueError("{} was trained on phrased tokens and cannot be frozen.".format(model_path))
+    frozen_path = frozen_model_path(model_path)
+    bigram_model.freeze().save(str(frozen_path))
+    return frozen_path
+
+
+def _export_phraser(model_path, threshold=None, scoring=None):
+    """Export the frozen phrase table of a phrase model, or keep the model itself if it cannot be frozen
+    (see has_phrased_tokens).
+
+    Returns:
+        str, float, str -- path, threshold and scoring of the phraser, see load_phrase_model
+    """
+    bigram_model = load_phrase_model(model_path, threshold=threshold, scoring=scoring)
+    if has_phrased_tokens(bigram_model):
+        return str(model_path), threshold, scoring
+    frozen_path = frozen_model_path(model_path)
+    bigram_model.freeze().save(str(frozen_path))
+    return str(frozen_path), None, None
+
+
+def cascade_transform(line, phrasers):
+    """ Apply phrase models one after the other to a line, in a single tokenization
+
+    Arguments:
+        line {str}: a line
+        phrasers {list}: phraser objects or phrase models, e.g. [bigram, trigram]
+        return: a line with phrases joined using "_"
+    """
+    tokens = line.split()
+    for phraser in phrasers:
+        tokens = phraser[tokens]
+    return " ".join(tokens)
+
+
+def _line_bigramer(phrasers):
+    """Build the batch function used by file_process.process_large_file to transform lines.
+    The phrase tables are loaded here, so that each worker process loads them once.
+
+    Arguments:
+        phrasers {list} -- (path, threshold, scoring) of the phrase tables, applied in order, see _export_phraser
+
+    Returns:
+        callable -- transform_lines(lines, line_ids)
+    """
+    phrasers = [load_phrase_model(path, threshold=threshold, scoring=scoring) for path, threshold, scoring in phrasers]
+
+    def transform_lines(lines, line_ids):
+        return [cascade_transform(line, phrasers) for line in lines], line_ids
+
+    return transform_lines
+
+
+def file_phraser(input_path, output_path, model_paths, threshold=None, scoring=None, workers=1, chunk_size=20000,
+                 resume=False, pipeline=False):
+    """ Transform an input text file with a cascade of phrase models in a single pass,
+    e.g. [bigram.mod, trigram.mod] turns the unigram corpus into the trigram corpus
+    without writing the bigram corpus. The output is the same as applying file_bigramer with each model in turn.
+    The phrase models trained on unigrams are exported as frozen phrase tables (see export_frozen_phrases),
+    the others are applied themselves (see has_phrased_tokens). The input is streamed in chunks through the
+    worker processes and written in order, so the memory does not grow with the corpus.
+
+    Arguments:
+        input_path {str}: Each line is a sentence
+        output_path {str}: Each line is a sentence with the phrases concatenated
+        model_paths {list}: Phrase models, applied in order
+        Both files can be compressed, chosen by the extension (see file_process.open_file)
+        threshold {float}: Threshold of all the phrase models, the trained ones if None (default: None)
+        scoring {str}: Name of the scoring function in gensim.models.phrases, the trained ones if None (default: None)
+        workers {int}: Number of processes (default: 1)
+        chunk_size {int}: Number of lines sent to a process at once (default: 20000)
+        resume {bool}: Continue an interrupted run from its checkpoint manifest (default: False)
+        pipeline {bool}: Overlap reading, transforming and writing with bounded queues (default: False)
+    """
+    Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+    phrasers = [_export_phraser(model_path, threshold=threshold, scoring=scoring) for model_path in model_paths]
+    file_process.process_large_file(
+        input_file=input_path,
+        output_file=output_path,
+        input_file_ids=None,
+        output_index_file=None,
+        function_factory=functools.partial(_line_bigramer, phrasers=phrasers),
+        chunk_size=chunk_size,
+        workers=workers,
+        resume=resume,
+        pipeline=pipeline,
+        batched=True,
+        params={
+            "stage": "phrase",
+            "models": [[str(p), Path(p).stat().st_mtime] for p in model_paths],
+            "threshold": threshold,
+            "scoring": scoring,
+        },
+    )
+    assert file_process.line_counter(input_path) == file_process.line_counter(output_path)
+
+
+def file_bigramer(input_path, output_path, model_path, threshold=None, scoring=None, workers=1, chunk_size=20000,
+                  resume=False, pipeline=False):
     """ Transform an input text file into a file with 2-word phrases.
-    Apply again to learn 3-word phrases.
+    Apply again to learn 3-word phrases, or use file_phraser to apply several models in one pass.
 
     Arguments:
         input_path {str}: Each line is a sentence
         ouput_file {str}: Each line is a sentence with 2-word phrases concatenated
+        Both files can be compressed, chosen by the extension (see file_process.open_file)
+        Other arguments: see file_phraser
     """
-    Path(output_path).parent.mkdir(parents=True, exist_ok=True)
     Path(model_path).parent.mkdir(parents=True, exist_ok=True)
-    bigram_model = gensim.models.phrases.Phrases.load(str(model_path))
-    if scoring is not None:
-        bigram_model.scoring = getattr(gensim.models.phrases, scoring)
-    if threshold is not None:
-        bigram_model.threshold = threshold
-    # bigram_phraser = models.phrases.Phraser(bigram_model)
-    with open(input_path, "r", encoding='utf-8') as f:
-        input_data = f.readlines()
-    data_bigram = [bigram_transform(l, bigram_model) for l in tqdm.tqdm(input_data)]
-    with open(output_path, "w", encoding='utf-8') as f:
-        f.write("\n".join(data_bigram) + "\n")
-    assert len(input_data) == file_process.line_counter(output_path)
\ No newline at end of file
+    file_phraser(
+        input_path,
+        output_path,
+        [model_path],
+        threshold=threshold,
+        scoring=scoring,
+        workers=workers,
+        chunk_size=chunk_size,
+        resume=resume,
+        pipeline=pipeline,
+    )
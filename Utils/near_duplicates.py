@@ -0,0 +1,285 @@
+"""
+Module: utils/near_duplicates.py
+Description: Near-duplicate detection of documents with MinHash signatures and LSH banding, so that only one
+representative of each cluster of near-duplicates (e.g. listings that differ only by the price, the phone number
+or the agent name) is parsed, and the parsed sentences are then copied back to every member of the cluster.
+
+The signatures are computed in a pool of processes while the input is streamed, and are kept on disk. Documents
+that share a band of their signature are candidates, the connected components of the candidates are clusters,
+and each member is kept in its cluster only if the estimated Jaccard similarity with the representative (the first
+document of the cluster) reaches the threshold.
+"""
+
+import functools
+import multiprocessing
+import zlib
+from pathlib import Path
+
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from Utils import document_ids, file_process
+
+REPRESENTATIVES_FILE = "documents.txt"
+REPRESENTATIVE_IDS_FILE = "document_ids.txt"
+CLUSTERS_FILE = "clusters.i64"
+_SIGNATURES_FILE = "signatures.u32"
+_BAND_KEYS_FILE = "band_keys.u64"
+
+# Largest prime below 2^32, the hash permutations are (a * x + b) mod _PRIME computed in uint64 without overflow.
+_PRIME = 4294967291
+
+
+def lsh_bands(threshold, num_perm):
+    """
+    Choose the LSH banding of the signatures for a similarity threshold.
+    Two documents with Jaccard similarity s share at least one band with probability 1 - (1 - s^rows)^bands,
+    the threshold of this curve is about (1 / bands)^(1 / rows). The largest number of rows with a curve threshold
+    not above the similarity threshold is chosen, so that few near-duplicates are missed; the false candidates
+    are removed by the verification.
+
+    Args:
+        threshold (float): Jaccard similarity threshold, in (0, 1].
+        num_perm (int): Number of hash permutations of the signatures.
+
+    Returns:
+        (int, int): Number of bands and number of rows per band.
+    """
+    rows = 1
+    for r in range(1, num_perm + 1):
+        if (1 / (num_perm // r)) ** (1 / r) <= threshold:
+            rows = r
+    return num_perm // rows, rows
+
+
+def _shingle_hashes(line, shingle_size):
+    """CRC32 of the word shingles of a document, the whole document is a single shingle if it is shorter"""
+    words = line.split()
+    if len(words) <= shingle_size:
+        return {zlib.crc32(" ".join(words).encode("utf-8"))}
+    return {
+        zlib.crc32(" ".join(words[i: i + shingle_size]).encode("utf-8"))
+        for i in range(len(words) - shingle_size + 1)
+    }
+
+
+def _chunk_signatures(lines, perm_a, perm_b, band_multipliers, shingle_size):
+    """
+    MinHash signatures and LSH band keys of a chunk of documents, run in the worker processes.
+
+    Args:
+        lines (list of str): Documents.
+        perm_a, perm_b (numpy.ndarray): uint64 coefficients of the hash permutations.
+        band_multipliers (numpy.ndarray): uint64 array (bands, rows) to hash each band into a key.
+        shingle_size (int): Number of words in a shingle.
+
+    Returns:
+        (numpy.ndarray, numpy.ndarray): uint32 signatures (documents, num_perm)
+            and uint64 band keys (documents, bands).
+    """
+    hashes = [np.fromiter(_shingle_hashes(line, shingle_size), dtype=np.uint64) for line in lines]
+    starts = np.cumsum([0] + [len(h) for h in hashes[:-1]])
+    permuted = (np.concatenate(hashes)[:, None] * perm_a[None, :] + perm_b[None, :]) % _PRIME
+    signatures = np.minimum.reduceat(permuted, starts, axis=0)
+    n_bands, rows = band_multipliers.shape
+    bands = signatures[:, : n_bands * rows].reshape(len(lines), n_bands, rows)
+    # integer arithmetic on uint64 arrays wraps around, which is what the hash needs
+    band_keys = (bands * band_multipliers[None, :, :]).sum(axis=2, dtype=np.uint64)
+    return signatures.astype(np.uint32), band_keys
+
+
+def _read_chunks(a_file, chunk_size):
+    """Stream a text file in lists of chunk_size lines"""
+    with file_process.open_file(a_file, encoding="utf-8") as f:
+        chunk = []
+        for line in f:
+            chunk.append(line)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def _clusters(band_keys, n_docs):
+    """
+    Connected components of the documents that share at least one band key.
+
+    Returns:
+        numpy.ndarray: int64 representative (smallest index in its component) of each document.
+    """
+    rows, cols = [], []
+    for band in range(band_keys.shape[1]):
+        keys = np.asarray(band_keys[:, band])
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        group_start = np.r_[True, sorted_keys[1:] != sorted_keys[:-1]]
+        # the stable sort keeps each group in document order, its first document has the smallest index
+        first = order[np.flatnonzero(group_start)][np.cumsum(group_start) - 1]
+        linked = first != order
+        rows.append(order[linked])
+        cols.append(first[linked])
+    rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+    cols = np.concatenate(cols) if cols else np.zeros(0, dtype=np.int64)
+    graph = coo_matrix((np.ones(len(rows), dtype=np.int8), (rows, cols)), shape=(n_docs, n_docs))
+    _, labels = connected_components(graph, directed=False)
+    first_of_label = np.full(labels.max() + 1 if n_docs else 0, n_docs, dtype=np.int64)
+    np.minimum.at(first_of_label, labels, np.arange(n_docs, dtype=np.int64))
+    return first_of_label[labels]
+
+
+def _verify(representatives, signatures, threshold, block_size=1 << 16):
+    """
+    Keep a document in its cluster only if its estimated Jaccard similarity with the representative
+    reaches the threshold, other documents become their own representative.
+    """
+    representatives = representatives.copy()
+    for start in range(0, len(representatives), block_size):
+        end = min(start + block_size, len(representatives))
+        reps = representatives[start:end]
+        members = np.flatnonzero(reps != np.arange(start, end)) + start
+        if len(members) == 0:
+            continue
+        similarity = (
+            np.asarray(signatures[members]) == np.asarray(signatures[representatives[members]])
+        ).mean(axis=1)
+        rejected = members[similarity < threshold]
+        representatives[rejected] = rejected
+    return representatives
+
+
+def deduplicate_file(input_path, id_path, output_dir, threshold=0.9, num_perm=128, shingle_size=3, workers=1,
+                     chunk_size=2000, seed=1):
+    """
+    Cluster the near-duplicate documents of a corpus and write one representative per cluster.
+
+    The output folder has:
+        documents.txt -- the representatives, in input order (the corpus to parse)
+        document_ids.txt -- the document IDs of the representatives
+        clusters.i64 -- int64 array, the line of the representative in documents.txt for each input document
+
+    Args:
+        input_path (str or Path): Corpus, each line is a document (e.g. the cleaned documents).
+        id_path (str or Path): Document ID file, each line is the ID of a document of the corpus.
+        output_dir (str or Path): Output folder, created if it does not exist.
+        threshold (float): Jaccard similarity of the word shingles above which documents are near-duplicates.
+                           Default 0.9.
+        num_perm (int): Number of hash permutations of the MinHash signatures. Default 128.
+        shingle_size (int): Number of words in a shingle. Default 3.
+        workers (int): Number of processes computing the signatures. Default 1.
+        chunk_size (int): Number of documents sent to a process at once. Default 2000.
+        seed (int): Seed of the hash permutations. Default 1.
+
+    Returns:
+        numpy.ndarray: The clusters.i64 array.
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    n_bands, rows = lsh_bands(threshold, num_perm)
+    rng = np.random.RandomState(seed)
+    perm_a = rng.randint(1, _PRIME, size=num_perm, dtype=np.uint64)
+    perm_b = rng.randint(0, _PRIME, size=num_perm, dtype=np.uint64)
+    band_multipliers = rng.randint(1, np.iinfo(np.int64).max, size=(n_bands, rows), dtype=np.uint64) | np.uint64(1)
+    print(f"Near-duplicates: threshold {threshold}, {n_bands} bands of {rows} rows.")
+
+    # signatures and band keys are appended to disk as the chunks come back, in input order
+    signatures_path = output_dir / _SIGNATURES_FILE
+    band_keys_path = output_dir / _BAND_KEYS_FILE
+    compute = functools.partial(
+        _chunk_signatures, perm_a=perm_a, perm_b=perm_b, band_multipliers=band_multipliers, shingle_size=shingle_size
+    )
+    n_docs = 0
+    with open(signatures_path, "wb") as f_signatures, open(band_keys_path, "wb") as f_band_keys:
+        if workers > 1:
+            pool = multiprocessing.Pool(workers)
+            results = pool.imap(compute, _read_chunks(input_path, chunk_size))
+        else:
+            pool = None
+            results = map(compute, _read_chunks(input_path, chunk_size))
+        try:
+            for signatures, band_keys in results:
+                signatures.tofile(f_signatures)
+                band_keys.tofile(f_band_keys)
+                n_docs += len(signatures)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    if n_docs:
+        signatures = np.memmap(signatures_path, dtype=np.uint32, mode="r", shape=(n_docs, num_perm))
+        band_keys = np.memmap(band_keys_path, dtype=np.uint64, mode="r", shape=(n_docs, n_bands))
+        representatives = _verify(_clusters(band_keys, n_docs), signatures, threshold)
+        del signatures, band_keys
+    else:
+        representatives = np.zeros(0, dtype=np.int64)
+    signatures_path.unlink()
+    band_keys_path.unlink()
+
+    is_representative = representatives == np.arange(n_docs)
+    representative_row = np.cumsum(is_representative) - 1
+    clusters = representative_row[representatives]
+    clusters.astype(np.int64).tofile(output_dir / CLUSTERS_FILE)
+
+    with file_process.open_file(input_path, encoding="utf-8") as f_in, \
+            file_process.open_file(id_path, encoding="utf-8") as f_ids, \
+            file_process.open_file(output_dir / REPRESENTATIVES_FILE, "w", encoding="utf-8", newline="\n") as f_out, \
+            file_process.open_file(output_dir / REPRESENTATIVE_IDS_FILE, "w", encoding="utf-8", newline="\n") as f_out_ids:
+        for keep, line, line_id in zip(is_representative, f_in, f_ids):
+            if keep:
+                f_out.write(line if line.endswith("\n") else line + "\n")
+                f_out_ids.write(line_id if line_id.endswith("\n") else line_id + "\n")
+    file_process.build_line_index(output_dir / REPRESENTATIVES_FILE)
+    file_process.build_line_index(output_dir / REPRESENTATIVE_IDS_FILE)
+    n_representatives = int(is_representative.sum())
+    print(
+        "Near-duplicates: {} documents, {} representatives, {:.1%} of the documents are not parsed.".format(
+            n_docs, n_representatives, 1 - n_representatives / n_docs if n_docs else 0
+        )
+    )
+    return clusters
+
+
+def expand_clusters(parsed_path, parsed_id_path, clusters_file, output_path, output_id_path):
+    """
+    Copy the parsed sentences of each representative to every document of its cluster, so that the output
+    is the same as parsing the whole corpus with parse.parse_document and integer sentence IDs.
+
+    Args:
+        parsed_path (str or Path): Parsed representatives, one sentence per line (uncompressed).
+        parsed_id_path (str or Path): Integer sentence IDs of the parsed representatives.
+        clusters_file (str or Path): The clusters.i64 array written by deduplicate_file.
+        output_path (str or Path): Parsed sentences of all the documents.
+        output_id_path (str or Path): Integer sentence IDs of all the documents.
+    """
+    if file_process.is_compressed(parsed_path):
+        raise ValueError("expand_clusters reads the parsed representatives through their line index, "
+                         "{} must not be compressed.".format(parsed_path))
+    clusters = np.fromfile(clusters_file, dtype=np.int64)
+    doc_index, sent_index = document_ids.read_sentence_ids(parsed_id_path)
+    # each representative has a block of lines: its sentences, or a blank line if it has none
+    new_block = np.r_[True, (doc_index[1:] != doc_index[:-1]) | (doc_index[1:] < 0)] if len(doc_index) else \
+        np.zeros(0, dtype=bool)
+    block_starts = np.r_[np.flatnonzero(new_block), len(doc_index)]
+    n_representatives = len(block_starts) - 1
+    assert len(clusters) == 0 or clusters.max() < n_representatives, \
+        "The parsed file has fewer documents than the representatives of the clusters."
+    offsets = file_process.load_line_index(parsed_path, build=True)
+
+    with open(parsed_path, "rb") as f_parsed, \
+            file_process.open_file(output_path, "wb") as f_out, \
+            file_process.open_file(output_id_path, "w", encoding="utf-8", newline="\n") as f_out_ids:
+        for i, row in enumerate(clusters):
+            start, end = block_starts[row], block_starts[row + 1]
+            f_parsed.seek(int(offsets[start]))
+            block = f_parsed.read(int(offsets[end]) - int(offsets[start]))
+            f_out.write(block if block.endswith(b"\n") else block + b"\n")
+            f_out_ids.write(
+                "".join(
+                    document_ids.format_sentence_id(i, s) + "\n" if d >= 0 else "\n"
+                    for d, s in zip(doc_index[start:end], sent_index[start:end])
+                )
+            )
+    file_process.build_line_index(output_path)
+    file_process.build_line_index(output_id_path)
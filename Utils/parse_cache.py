@@ -0,0 +1,129 @@
+"""
+Module: utils/parse_cache.py
+Description: Persistent, content-addressed cache of parsed documents. A SQLite database maps the hash of
+(document text, parser configuration) to the sentences of the document, so that a re-run of the parse stage
+only parses the new or changed documents. The configuration includes the spaCy model name and version and
+the lemma/ner/pos options, a change of any of them misses the cache.
+"""
+
+import hashlib
+import json
+import sqlite3
+from pathlib import Path
+
+from Utils import file_process
+
+
+class ParseCache:
+    """
+    Cache of SpacyParser.sentence_split results in a SQLite database, shared by the parser processes.
+    Each process opens its own connection; the database is in WAL mode so that readers do not block the writer.
+    """
+
+    def __init__(self, db_path, config, timeout=600):
+        """
+        Args:
+            db_path (str or Path): SQLite database file, created if it does not exist.
+            config (dict): Parser configuration (model name and version, options) that is hashed with each text.
+            timeout (float): Seconds to wait for the lock of another process. Default 600.
+        """
+        self.db_path = db_path
+        self.config = config
+        self.config_key = bytes.fromhex(file_process.params_hash(config))
+        self.hits = 0
+        self.misses = 0
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(db_path), timeout=timeout)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS parses (key BLOB PRIMARY KEY, sentences TEXT NOT NULL)")
+        self._conn.commit()
+
+    def key(self, text):
+        """
+        Args:
+            text (str): A document.
+
+        Returns:
+            bytes: 16-byte hash of the text and the parser configuration.
+        """
+        return hashlib.blake2b(text.encode("utf-8"), digest_size=16, key=self.config_key).digest()
+
+    def get_many(self, texts):
+        """
+        Look up a batch of documents.
+
+        Args:
+            texts (list of str): Documents.
+
+        Returns:
+            list: For each document, its cached list of (sentence_id, sentence) tuples, or None if it is not cached.
+        """
+        keys = [self.key(text) for text in texts]
+        found = {}
+        # stay below the SQLite limit on the number of query parameters
+        for start in range(0, len(keys), 900):
+            batch = keys[start: start + 900]
+            rows = self._conn.execute(
+                "SELECT key, sentences FROM parses WHERE key IN ({})".format(",".join("?" * len(batch))), batch
+            )
+            found.update(rows)
+        results = []
+        for k in keys:
+            if k in found:
+                results.append([tuple(item) for item in json.loads(found[k])])
+            else:
+                results.append(None)
+        n_hits = sum(r is not None for r in results)
+        self.hits += n_hits
+        self.misses += len(results) - n_hits
+        return results
+
+    def get(self, text):
+        """
+        Args:
+            text (str): A document.
+
+        Returns:
+            list or None: The cached list of (sentence_id, sentence) tuples, None if the document is not cached.
+        """
+        return self.get_many([text])[0]
+
+    def put_many(self, texts, results):
+        """
+        Store the sentences of a batch of documents in one transaction.
+
+        Args:
+            texts (list of str): Documents.
+            results (list): For each document, its list of (sentence_id, sentence) tuples.
+        """
+        rows = [
+            (self.key(text), json.dumps(sentences, ensure_ascii=False)) for text, sentences in zip(texts, results)
+        ]
+        with self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO parses (key, sentences) VALUES (?, ?)", rows)
+
+    def put(self, text, sentences):
+        """
+        Args:
+            text (str): A document.
+            sentences (list): Its list of (sentence_id, sentence) tuples.
+        """
+        self.put_many([text], [sentences])
+
+    def hit_rate(self):
+        """
+        Returns:
+            float: Fraction of the lookups that were found in the cache, 0 before any lookup.
+        """
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def close(self):
+        self._conn.close()
+
+    def __getstate__(self):
+        return {"db_path": self.db_path, "config": self.config}
+
+    def __setstate__(self, state):
+        self.__init__(state["db_path"], state["config"])
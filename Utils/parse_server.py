@@ -0,0 +1,254 @@
+"""
+Module: utils/parse_server.py
+Description: Resident parser process that keeps the spaCy models, the TextCleaners and the phrase models loaded,
+and serves batches of lines over a Unix domain socket, so that small incremental jobs do not pay for loading them.
+
+Start the server with
+    python -m Utils.parse_server [socket_path]
+(global_options.PARSER_SOCKET by default) and pass the socket path to parse.parse_document(server=...),
+or use ParserClient directly. The client only needs the standard library.
+
+The socket and its key file (socket_path + ".key") are only accessible to the owner. Connections are authenticated
+with the random key of the server before any request is unpickled.
+"""
+
+import os
+import secrets
+import sys
+import time
+from multiprocessing.connection import AuthenticationError, Client, Listener
+from pathlib import Path
+
+
+def key_path(socket_path):
+    """
+    Args:
+        socket_path (str or Path): Unix domain socket of the server.
+
+    Returns:
+        str: File of the key that authenticates the clients of the server.
+    """
+    return str(socket_path) + ".key"
+
+
+class ParserClient:
+    """
+    Thin client of a parse server. Each method sends one batch and waits for the result.
+    """
+
+    def __init__(self, socket_path):
+        """
+        Args:
+            socket_path (str or Path): Unix domain socket of the server.
+        """
+        self.socket_path = str(socket_path)
+        with open(key_path(self.socket_path), "rb") as f:
+            authkey = f.read()
+        self._conn = Client(self.socket_path, family="AF_UNIX", authkey=authkey)
+
+    def _request(self, op, **kwargs):
+        self._conn.send({"op": op, **kwargs})
+        status, result = self._conn.recv()
+        if status == "error":
+            raise RuntimeError("Parse server error: {}".format(result))
+        return result
+
+    def ping(self):
+        """
+        Returns:
+            dict: Uptime of the server in seconds and the loaded models.
+        """
+        return self._request("ping")
+
+    def parse(self, lines, **options):
+        """
+        Parse a batch of documents, as SpacyParser.sentence_split.
+
+        Args:
+            lines (list of str): Documents.
+            **options: Options of SpacyParser.pipe_sentences (e.g. lemma=True, single_pass=True).
+
+        Returns:
+            list: For each document, its list of (sentence_id, processed_sentence) tuples.
+        """
+        return self._request("parse", lines=lines, options=options)
+
+    def clean(self, lines, **options):
+        """
+        Clean a batch of lines, as TextCleaner.clean_many.
+
+        Args:
+            lines (list of str): Lines.
+            **options: Keyword arguments to configure the TextCleaner.
+
+        Returns:
+            list of str: Cleaned lines.
+        """
+        return self._request("clean", lines=lines, options=options)
+
+    def phrase(self, lines, model_path, threshold=None, scoring=None):
+        """
+        Join the phrases of a batch of lines, as multiple_word_detect.file_bigramer.
+
+        Args:
+            lines (list of str): Lines.
+            model_path (str or Path): Phrase model.
+            threshold (float, optional): Threshold of the phrase model.
+            scoring (str, optional): Name of the scoring function in gensim.models.phrases.
+
+        Returns:
+            list of str: Lines with the phrases joined by "_".
+        """
+        return self._request(
+            "phrase", lines=lines, options={"model_path": str(model_path), "threshold": threshold, "scoring": scoring}
+        )
+
+    def shutdown(self):
+        """Stop the server."""
+        self._request("shutdown")
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _Models:
+    """Models loaded by the server, keyed by their options"""
+
+    def __init__(self):
+        self.parsers = {}
+        self.cleaners = {}
+        self.phrasers = {}
+
+    def parser(self, options):
+        from Utils.parser import SpacyParser
+
+        features = tuple(f for f in ("lemma", "ner", "pos") if options.get(f))
+        if features not in self.parsers:
+            self.parsers[features] = SpacyParser(features=features)
+        return self.parsers[features]
+
+    def cleaner(self, options):
+        from Utils.text_cleaning import TextCleaner
+
+        key = repr(sorted((k, sorted(v) if isinstance(v, (set, frozenset)) else v) for k, v in options.items()))
+        if key not in self.cleaners:
+            self.cleaners[key] = TextCleaner(**options)
+        return self.cleaners[key]
+
+    def phraser(self, options):
+        from Utils import multiple_word_detect
+
+        model_path = options["model_path"]
+        # a retrained model is loaded again
+        key = (model_path, os.path.getmtime(model_path), options.get("threshold"), options.get("scoring"))
+        if key not in self.phrasers:
+            model = multiple_word_detect.load_phrase_model(
+                model_path, threshold=options.get("threshold"), scoring=options.get("scoring")
+            )
+            self.phrasers = {k: v for k, v in self.phrasers.items() if k[0] != model_path}
+            # a model trained on phrased tokens is kept unfrozen, see multiple_word_detect.has_phrased_tokens
+            self.phrasers[key] = multiple_word_detect.freeze_phrases(model)
+        return self.phrasers[key]
+
+
+def _handle(models, request):
+    """Run a request of a client and return its result"""
+    op = request["op"]
+    options = request.get("options", {})
+    if op == "parse":
+        lines = request["lines"]
+        parser = models.parser(options)
+        doc_sentences = [[] for _ in lines]
+        for i, idx, sentence_text in parser.pipe_sentences(lines, sort_window=len(lines), **options):
+            doc_sentences[i].append((idx, sentence_text))
+        return doc_sentences
+    if op == "clean":
+        return models.cleaner(options).clean_many(request["lines"])
+    if op == "phrase":
+        phraser = models.phraser(options)
+        return [" ".join(phraser[line.split()]) for line in request["lines"]]
+    raise ValueError("Unknown operation {}".format(op))
+
+
+def serve(socket_path):
+    """
+    Serve requests on a Unix domain socket until a client sends shutdown.
+    Clients are served one at a time; a client can send any number of requests on its connection.
+
+    Args:
+        socket_path (str or Path): Unix domain socket, replaced if it exists; only the owner can connect.
+    """
+    socket_path = str(socket_path)
+    Path(socket_path).parent.mkdir(parents=True, exist_ok=True)
+    for a_file in (socket_path, key_path(socket_path)):
+        if os.path.exists(a_file):
+            os.unlink(a_file)
+    models = _Models()
+    start_time = time.time()
+    authkey = secrets.token_bytes(32)
+    # the socket and the key file are created with mode 0600
+    old_umask = os.umask(0o177)
+    try:
+        with open(key_path(socket_path), "wb") as f:
+            f.write(authkey)
+        listener = Listener(socket_path, family="AF_UNIX", authkey=authkey)
+    finally:
+        os.umask(old_umask)
+    print("Parse server listening on {}.".format(socket_path))
+    running = True
+    try:
+        while running:
+            try:
+                conn = listener.accept()
+            except (AuthenticationError, EOFError) as e:
+                print("Rejected a connection: {}".format(e))
+                continue
+            with conn:
+                while True:
+                    try:
+                        request = conn.recv()
+                    except EOFError:
+                        break
+                    if request.get("op") == "shutdown":
+                        conn.send(("ok", None))
+                        running = False
+                        break
+                    if request.get("op") == "ping":
+                        conn.send((
+                            "ok",
+                            {
+                                "uptime": time.time() - start_time,
+                                "parsers": [list(k) for k in models.parsers],
+                                "cleaners": len(models.cleaners),
+                                "phrasers": [k[0] for k in models.phrasers],
+                            },
+                        ))
+                        continue
+                    try:
+                        conn.send(("ok", _handle(models, request)))
+                    except Exception as e:
+                        print(e)
+                        conn.send(("error", repr(e)))
+    finally:
+        listener.close()
+        for a_file in (socket_path, key_path(socket_path)):
+            if os.path.exists(a_file):
+                os.unlink(a_file)
+        print("Parse server stopped.")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        serve(sys.argv[1])
+    else:
+        import global_options
+
+        if global_options.PARSER_SOCKET is None:
+            sys.exit("No socket: pass its path or set PARSER_SOCKET in global_options.py.")
+        serve(global_options.PARSER_SOCKET)
@@ -1,25 +1,181 @@
+import collections
+import functools
+import itertools
+import multiprocessing
+import time
+
 import spacy
+from spacy.tokens import Doc
+
+# Components of the trained pipelines (e.g. en_core_web_sm) needed by each output.
+FEATURE_COMPONENTS = {
+    "lemma": ("tok2vec", "tagger", "attribute_ruler", "lemmatizer"),
+    "pos": ("tok2vec", "tagger", "attribute_ruler"),
+    "ner": ("tok2vec", "ner"),
+}
+# Components of the trained pipelines that are turned off when no requested output needs them.
+# The sentences come from the senter when the parser is off.
+PIPELINE_COMPONENTS = ("tok2vec", "tagger", "morphologizer", "attribute_ruler", "lemmatizer", "parser", "senter", "ner")
 
 
 class SpacyParser:
-    def __init__(self, model="en_core_web_sm", use_gpu=False):
+    def __init__(self, model="en_core_web_sm", use_gpu=False, features=None, max_chars=100000):
         """
         Initialize by loading the specified spaCy language model (default is English).
+
+        :param model: Name or path of the spaCy pipeline.
+        :param use_gpu: If True, run spaCy on the GPU.
+        :param features: Outputs that will be requested, among "lemma", "ner" and "pos". If given, only the
+                         components these outputs need are enabled (e.g. "lemma" runs tok2vec, tagger,
+                         attribute_ruler, lemmatizer and senter, without the dependency parser and NER).
+                         If None, the full pipeline is used.
+        :param max_chars: Documents longer than this are parsed in pieces, see split_text.
+                          Capped at nlp.max_length.
         """
         if use_gpu:
             spacy.require_gpu()
+        self.model = model
         self.nlp = spacy.load(model)
+        self.profile = "full"
+        self.max_chars = min(max_chars, self.nlp.max_length)
+        if features is not None:
+            self._select_components(features)
+        print(f"spaCy profile: {self.profile} ({', '.join(self.nlp.pipe_names)})")
+
+    def config(self, **kwargs):
+        """
+        Configuration that determines the output of the parser, e.g. to key a cache of parsed documents.
+
+        :param kwargs: Options passed to sentence_split (e.g. lemma=True).
+        :return: A dict with the model name and version, the spaCy version, the profile and the options.
+        """
+        return {
+            "model": self.model,
+            "model_version": self.nlp.meta.get("version"),
+            "spacy_version": spacy.__version__,
+            "profile": self.profile,
+            **kwargs,
+        }
+
+    def _select_components(self, features):
+        """
+        Enable only the pipeline components needed by the features, see FEATURE_COMPONENTS.
+
+        :param features: Iterable of "lemma", "ner" and "pos".
+        """
+        features = sorted(set(features))
+        unknown = [f for f in features if f not in FEATURE_COMPONENTS]
+        if unknown:
+            raise ValueError(f"Unknown features {unknown}, expected some of {sorted(FEATURE_COMPONENTS)}.")
+        needed = {"senter"}.union(*(FEATURE_COMPONENTS[f] for f in features))
+        for name in self.nlp.component_names:
+            if name not in PIPELINE_COMPONENTS:
+                continue
+            if name in needed and name in self.nlp.disabled:
+                self.nlp.enable_pipe(name)
+            elif name not in needed and name not in self.nlp.disabled:
+                self.nlp.disable_pipe(name)
+        if not any(name in self.nlp.pipe_names for name in ("parser", "senter", "sentencizer")):
+            self.nlp.add_pipe("sentencizer", first=True)
+        self.profile = "+".join(features) if features else "sentences"
+
+    def split_text(self, text):
+        """
+        Split a document longer than max_chars into pieces at safe boundaries: the last line break,
+        else the last sentence end (". "), else the last space in the second half of the window.
+        A sentence always ends at the end of a piece.
+
+        :param text: Input text.
+        :return: A list of pieces, [text] if the text is short enough.
+        """
+        max_chars = self.max_chars
+        pieces = []
+        start = 0
+        while len(text) - start > max_chars:
+            end = start + max_chars
+            cut = end
+            for separator in ("\n", ". ", " "):
+                k = text.rfind(separator, start + max_chars // 2, end)
+                if k != -1:
+                    cut = k + len(separator)
+                    break
+            pieces.append(text[start:cut])
+            start = cut
+        pieces.append(text[start:])
+        return pieces
+
+    def _pieces(self, texts, ids):
+        """
+        Split the long documents of a stream, see split_text.
+
+        :return: A generator of tuples (piece, (position of the document in the stream, doc_id)).
+        """
+        for position, (text, doc_id) in enumerate(zip(texts, ids)):
+            for piece in self.split_text(text):
+                yield piece, (position, doc_id)
+
+    def _pipe_sorted(self, stream, batch_size=1000, n_process=1, sort_window=None):
+        """
+        nlp.pipe on a stream of (text, key) tuples. With sort_window, the texts of each window of sort_window
+        tuples are sent to spaCy sorted by length, so that each batch has texts of similar length,
+        and the Docs are put back in input order.
+
+        :return: A generator of tuples (Doc, key), in input order.
+        """
+        if not sort_window:
+            yield from self.nlp.pipe(stream, as_tuples=True, batch_size=batch_size, n_process=n_process)
+            return
+        window_orders = collections.deque()
+
+        def sorted_stream():
+            while True:
+                window = list(itertools.islice(stream, sort_window))
+                if not window:
+                    return
+                order = sorted(range(len(window)), key=lambda k: len(window[k][0]))
+                window_orders.append(order)
+                for k in order:
+                    yield window[k]
+
+        results = self.nlp.pipe(sorted_stream(), as_tuples=True, batch_size=batch_size, n_process=n_process)
+        for first in results:
+            # spaCy reads the stream ahead of its results, the order of the window is known by now
+            order = window_orders.popleft()
+            window_docs = [None] * len(order)
+            window_docs[order[0]] = first
+            for k in order[1:]:
+                window_docs[k] = next(results)
+            yield from window_docs
 
-    def sentence_split(self, text, lemma=False, ner=False, pos=False):
+    def sentence_split(self, text, lemma=False, ner=False, pos=False, single_pass=False):
         """
         Split the input text into sentences and process each sentence.
+        A text longer than max_chars is processed in pieces (see split_text) and the sentence IDs run on
+        across the pieces.
 
         :param text: Input text.
         :param lemma: If True, perform lemmatization on the text.
         :param ner: If True, apply NER formatting.
         :param pos: If True, append POS tags.
+        :param single_pass: If True, run the pipeline once on the text and build the sentences, lemmas
+                            and NER/POS markup from that single Doc (see render_sentence). Sentence
+                            boundaries are then found on the original text instead of the lemmatized text.
         :return: A list of tuples (sentence_id, processed_sentence).
         """
+        pieces = self.split_text(text)
+        if len(pieces) > 1:
+            sentences = []
+            for piece in pieces:
+                for _, sentence_text in self.sentence_split(piece, lemma=lemma, ner=ner, pos=pos,
+                                                            single_pass=single_pass):
+                    sentences.append((len(sentences), sentence_text))
+            return sentences
+        if single_pass:
+            doc = self.nlp(text)
+            return [
+                (idx, self.render_sentence(sent, lemma=lemma, ner=ner, pos=pos))
+                for idx, sent in enumerate(doc.sents)
+            ]
         # Optionally apply lemmatization to the entire text first.
         if lemma:
             text = self.lemma(text)
@@ -38,6 +194,166 @@ class SpacyParser:
             sentences.append((idx, sentence_text))
         return sentences
 
+    def pipe_sentences(self, texts, ids=None, batch_size=1000, n_process=1, lemma=False, ner=False, pos=False,
+                       single_pass=False, sort_window=None):
+        """
+        Split a stream of documents into sentences with nlp.pipe, so that spaCy processes
+        the documents in batches and, with n_process > 1, in several processes.
+        Gives the same sentences as sentence_split on each document.
+
+        :param texts: Iterable of documents.
+        :param ids: Iterable of document IDs, the positions 0, 1, ... if None.
+        :param batch_size: Number of documents in each batch sent to spaCy.
+        :param n_process: Number of spaCy processes.
+        :param lemma: If True, perform lemmatization on the text.
+        :param ner: If True, apply NER formatting.
+        :param pos: If True, append POS tags.
+        :param single_pass: If True, run the pipeline once on each document, see sentence_split.
+        :param sort_window: Sort the documents by length within windows of this many documents, see pipe_docs.
+                            Only with single_pass, otherwise each batch of batch_size documents is processed at once.
+        :return: A generator of tuples (doc_id, sentence_id, processed_sentence), in input order.
+        """
+        if single_pass:
+            for doc, doc_id in self.pipe_docs(texts, ids=ids, batch_size=batch_size, n_process=n_process,
+                                              sort_window=sort_window):
+                for idx, sent in enumerate(doc.sents):
+                    yield doc_id, idx, self.render_sentence(sent, lemma=lemma, ner=ner, pos=pos)
+            return
+        if ids is None:
+            ids = itertools.count()
+        stream = self._pieces(texts, ids)
+        start_time = time.perf_counter()
+        n_docs = 0
+        batches = iter(lambda: list(itertools.islice(stream, batch_size)), [])
+        options = {"batch_size": batch_size, "lemma": lemma, "ner": ner, "pos": pos}
+        if n_process > 1:
+            # each worker runs all the passes of its batches, so that there are n_process spaCy processes
+            pool = multiprocessing.Pool(n_process, initializer=_init_worker, initargs=(self,))
+            results = pool.imap(functools.partial(_two_pass_worker, **options), batches)
+        else:
+            pool = None
+            results = (self._two_pass(batch, **options) for batch in batches)
+        previous_position = None
+        try:
+            for batch_sentences in results:
+                for (position, doc_id), sentences in batch_sentences:
+                    # the sentence IDs of a document run on across its pieces
+                    if position != previous_position:
+                        n_docs += 1
+                        idx = 0
+                        previous_position = position
+                    for sentence_text in sentences:
+                        yield doc_id, idx, sentence_text
+                        idx += 1
+        finally:
+            if pool is not None:
+                pool.terminate()
+        self._log_throughput(n_docs, start_time)
+
+    def _two_pass(self, batch, batch_size=1000, lemma=False, ner=False, pos=False):
+        """
+        Process a batch of (text, key) tuples as sentence_split without single_pass, with nlp.pipe for each pass:
+        lemmatize the texts, split the (lemmatized) texts into sentences, and mark up the sentences with NER/POS.
+
+        :param batch: List of (text, key) tuples.
+        :return: A list of tuples (key, list of processed sentences), in input order.
+        """
+        texts = [text for text, _ in batch]
+        if lemma:
+            texts = [" ".join(token.lemma_ for token in doc) for doc in self.nlp.pipe(texts, batch_size=batch_size)]
+        doc_sentences = [[sent.text for sent in doc.sents] for doc in self.nlp.pipe(texts, batch_size=batch_size)]
+        if ner or pos:
+            sentence_docs = self.nlp.pipe(
+                (sentence for sentences in doc_sentences for sentence in sentences), batch_size=batch_size
+            )
+            doc_sentences = [
+                [self._markup(next(sentence_docs), ner=ner, pos=pos) for _ in sentences]
+                for sentences in doc_sentences
+            ]
+        return [(key, sentences) for (_, key), sentences in zip(batch, doc_sentences)]
+
+    def pipe_docs(self, texts, ids=None, batch_size=1000, n_process=1, sort_window=None):
+        """
+        Run the pipeline once on each document of a stream with nlp.pipe.
+        A document longer than max_chars is parsed in pieces (see split_text) that are joined into one Doc.
+
+        :param texts: Iterable of documents.
+        :param ids: Iterable of document IDs, the positions 0, 1, ... if None.
+        :param batch_size: Number of documents in each batch sent to spaCy.
+        :param n_process: Number of spaCy processes.
+        :param sort_window: If given, the documents of each window of sort_window documents are sent to spaCy
+                            sorted by length, so that the batches do not mix short and long documents.
+                            The output is still in input order.
+        :return: A generator of tuples (Doc, doc_id), in input order.
+        """
+        if ids is None:
+            ids = itertools.count()
+        start_time = time.perf_counter()
+        n_docs = 0
+        group = []
+        group_key = None
+        for doc, key in self._pipe_sorted(self._pieces(texts, ids), batch_size, n_process, sort_window):
+            if group and key[0] != group_key[0]:
+                n_docs += 1
+                yield (group[0] if len(group) == 1 else Doc.from_docs(group)), group_key[1]
+                group = []
+            group.append(doc)
+            group_key = key
+        if group:
+            n_docs += 1
+            yield (group[0] if len(group) == 1 else Doc.from_docs(group)), group_key[1]
+        self._log_throughput(n_docs, start_time)
+
+    def _log_throughput(self, n_docs, start_time):
+        """
+        Print the number of documents parsed per second with the current profile.
+
+        :param n_docs: Number of documents parsed.
+        :param start_time: time.perf_counter() when the parsing started.
+        """
+        elapsed = time.perf_counter() - start_time
+        docs_per_sec = n_docs / elapsed if elapsed > 0 else float("inf")
+        print(f"spaCy profile {self.profile}: {n_docs} docs, {docs_per_sec:.1f} docs/sec.")
+
+    @staticmethod
+    def render_sentence(sent, lemma=False, ner=False, pos=False):
+        """
+        Build the processed text of a sentence from the annotations of an already parsed Doc,
+        with the same formats as lemma, ner, pos and ner_pos.
+
+        :param sent: A sentence Span of a parsed Doc.
+        :param lemma: If True, use the lemma of each token.
+        :param ner: If True, merge the tokens of each entity and prepend [NER:ENTITY_TYPE].
+        :param pos: If True, append [POS:TAG] to the tokens that are not part of an entity (if ner).
+        :return: Processed sentence, tokens separated by spaces.
+        """
+        if not (lemma or ner or pos):
+            return sent.text
+        tokens = []
+        i = 0
+        n = len(sent)
+        while i < n:
+            token = sent[i]
+            # token.is_space needs the lexeme attributes of the language, which a deserialized Doc does not have
+            if token.text.isspace():
+                i += 1
+                continue
+            word = token.lemma_ if lemma else token.text
+            if ner and token.ent_iob_ == 'B':
+                ent_tokens = [word]
+                ent_type = token.ent_type_
+                i += 1
+                # Collect subsequent tokens inside the same entity and sentence.
+                while i < n and sent[i].ent_iob_ == 'I':
+                    ent_tokens.append(sent[i].lemma_ if lemma else sent[i].text)
+                    i += 1
+                merged_ent = "_".join(ent_tokens)
+                tokens.append(f"[NER:{ent_type}]{merged_ent}")
+            else:
+                tokens.append(f"{word}[POS:{token.pos_}]" if pos else word)
+                i += 1
+        return " ".join(tokens)
+
     def lemma(self, sentence):
         """
         Perform lemmatization on the sentence.
@@ -58,25 +374,7 @@ class SpacyParser:
         :param sentence: Input sentence.
         :return: Processed sentence with formatted named entities.
         """
-        doc = self.nlp(sentence)
-        tokens = []
-        i = 0
-        while i < len(doc):
-            token = doc[i]
-            if token.ent_iob_ == 'B':
-                ent_tokens = [token.text]
-                ent_type = token.ent_type_
-                i += 1
-                # Collect subsequent tokens inside the same entity.
-                while i < len(doc) and doc[i].ent_iob_ == 'I':
-                    ent_tokens.append(doc[i].text)
-                    i += 1
-                merged_ent = "_".join(ent_tokens)
-                tokens.append(f"[NER:{ent_type}]{merged_ent}")
-            else:
-                tokens.append(token.text)
-                i += 1
-        return " ".join(tokens)
+        return self._markup(self.nlp(sentence), ner=True)
 
     def pos(self, sentence):
         """
@@ -86,9 +384,7 @@ class SpacyParser:
         :param sentence: Input sentence.
         :return: Processed sentence with POS tags appended.
         """
-        doc = self.nlp(sentence)
-        tokens = [f"{token.text}[POS:{token.pos_}]" for token in doc]
-        return " ".join(tokens)
+        return self._markup(self.nlp(sentence), pos=True)
 
     def ner_pos(self, sentence):
         """
@@ -100,26 +396,51 @@ class SpacyParser:
         :param sentence: Input sentence.
         :return: Processed sentence with combined NER formatting and POS tagging.
         """
-        doc = self.nlp(sentence)
+        return self._markup(self.nlp(sentence), ner=True, pos=True)
+
+    @staticmethod
+    def _markup(doc, ner=False, pos=False):
+        """
+        NER and/or POS markup of a Doc parsed from a sentence, see ner, pos and ner_pos.
+
+        :param doc: The parsed sentence.
+        :param ner: If True, merge the tokens of each entity and prepend [NER:ENTITY_TYPE].
+        :param pos: If True, append [POS:TAG] to the tokens that are not part of an entity (if ner).
+        :return: Processed sentence, tokens separated by spaces.
+        """
         tokens = []
         i = 0
         while i < len(doc):
             token = doc[i]
-            if token.ent_iob_ == 'B':
+            if ner and token.ent_iob_ == 'B':
                 ent_tokens = [token.text]
                 ent_type = token.ent_type_
                 i += 1
+                # Collect subsequent tokens inside the same entity.
                 while i < len(doc) and doc[i].ent_iob_ == 'I':
                     ent_tokens.append(doc[i].text)
                     i += 1
                 merged_ent = "_".join(ent_tokens)
                 tokens.append(f"[NER:{ent_type}]{merged_ent}")
             else:
-                tokens.append(f"{token.text}[POS:{token.pos_}]")
+                tokens.append(f"{token.text}[POS:{token.pos_}]" if pos else token.text)
                 i += 1
         return " ".join(tokens)
 
 
+_worker_parser = None
+
+
+def _init_worker(parser):
+    """Keep the SpacyParser of the parent in each worker process of pipe_sentences"""
+    global _worker_parser
+    _worker_parser = parser
+
+
+def _two_pass_worker(batch, **options):
+    return _worker_parser._two_pass(batch, **options)
+
+
 # Example usage:
 if __name__ == "__main__":
 
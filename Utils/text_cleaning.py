@@ -3,7 +3,10 @@ Module: utils/clean.py
 Description: Provides text cleaning functions encapsulated in the TextCleaner class.
 """
 
+import hashlib
+import json
 import re
+from collections import OrderedDict
 from nltk.corpus import stopwords
 
 
@@ -19,6 +22,7 @@ class TextCleaner:
 
     def __init__(self, to_lower=False, remove_num=False, remove_punc=False, remove_extra_punc=False,
                  remove_stop=False, remove_single=False, custom_stop=None, language='english',
+                 compiled=True, memo_size=0,
                  ):
         """
         Initialize the TextCleaner with the specified cleaning options.
@@ -34,6 +38,13 @@ class TextCleaner:
             custom_stop (set, optional): A custom set of stopwords. If not provided,
                                           the NLTK stopword set for the given language is used.
             language (str): The language to use for NLTK stopwords (default is 'english').
+            compiled (bool): Whether to clean with the compiled plan: the enabled options are fused into
+                             precompiled patterns and a single tokenize-filter-join pass. The output is
+                             identical to applying the cleaning operations one by one.
+            memo_size (int): Max number of cleaned lines kept in an LRU memo, 0 disables the memo.
+                             Repeated lines (e.g. agent boilerplate, relisted properties) are then
+                             cleaned once. The memo is keyed by a 16-byte hash of the line and of the
+                             cleaner config, so its memory does not depend on the length of the lines.
         """
         self.to_lower = to_lower
         self.remove_num = remove_num
@@ -57,6 +68,36 @@ class TextCleaner:
                     self.stops = set(stopwords.words(language))
         else:
             self.stops = set()
+        # Frozen once, instead of building the union for every word.
+        self._stop_filter = frozenset(self.stops | {"-lrb-", "-rrb-", "-lsb-", "-rsb-", "'s"})
+
+        self.compiled = compiled
+        self._compile()
+
+        self.memo_size = memo_size
+        self._memo = OrderedDict()
+        self.memo_hits = 0
+        self.memo_misses = 0
+        config = [to_lower, remove_num, remove_punc, remove_extra_punc, remove_stop, remove_single,
+                  sorted(self.stops)]
+        self._config_key = hashlib.blake2b(json.dumps(config).encode("utf-8"), digest_size=32).digest()
+
+    def _compile(self):
+        """
+        Build the compiled cleaning plan from the enabled options.
+
+        Replacing each run of punctuation by one space gives the same text as replacing each
+        punctuation character by a space once whitespace is normalized, and repeated punctuation
+        does not need to be normalized if it is removed anyway. Whitespace normalization,
+        stopword removal and single-character removal are fused in one split-filter-join pass.
+        """
+        self._substitutions = []
+        if self.remove_num:
+            self._substitutions.append((re.compile(r'\d+'), ''))
+        if self.remove_punc:
+            self._substitutions.append((re.compile(r'[^\w\s]+'), ' '))
+        elif self.remove_extra_punc:
+            self._substitutions.append((re.compile(r'([^\w\s])\1+'), r'\1'))
 
     def _to_lower(self, text):
         """
@@ -131,7 +172,7 @@ class TextCleaner:
         Returns:
             str: Text with stopwords removed.
         """
-        return " ".join(word for word in text.split() if word not in self.stops | {"-lrb-", "-rrb-", "-lsb-", "-rsb-", "'s"})
+        return " ".join(word for word in text.split() if word not in self._stop_filter)
 
     def _remove_single(self, text):
         """
@@ -151,6 +192,22 @@ class TextCleaner:
         """
         Clean the input text by applying the configured cleaning operations.
 
+        Args:
+            text (str): The input text.
+
+        Returns:
+            str: The cleaned text.
+        """
+        if self.memo_size:
+            return self._clean_memoized(text)
+        if self.compiled:
+            return self._clean_compiled(text)
+        return self._clean_steps(text)
+
+    def _clean_steps(self, text):
+        """
+        Clean the input text by applying the cleaning operations one by one.
+
         Args:
             text (str): The input text.
 
@@ -171,3 +228,78 @@ class TextCleaner:
         if self.remove_single:
             text = self._remove_single(text)
         return text
+
+    def _clean_compiled(self, text):
+        """
+        Clean the input text with the compiled plan (see _compile).
+
+        Args:
+            text (str): The input text.
+
+        Returns:
+            str: The cleaned text.
+        """
+        if self.to_lower:
+            text = text.lower()
+        for pattern, replacement in self._substitutions:
+            text = pattern.sub(replacement, text)
+        if self.remove_stop:
+            stops = self._stop_filter
+            if self.remove_single:
+                return " ".join([word for word in text.split() if len(word) > 1 and word not in stops])
+            return " ".join([word for word in text.split() if word not in stops])
+        if self.remove_single:
+            return " ".join([word for word in text.split() if len(word) > 1])
+        return " ".join(text.split())
+
+    def clean_many(self, lines):
+        """
+        Clean a batch of lines.
+
+        Args:
+            lines (iterable of str): The input lines.
+
+        Returns:
+            list of str: The cleaned lines, in the same order.
+        """
+        if self.memo_size:
+            clean = self._clean_memoized
+        elif self.compiled:
+            clean = self._clean_compiled
+        else:
+            clean = self._clean_steps
+        return [clean(line) for line in lines]
+
+    def _clean_memoized(self, text):
+        """
+        Clean the input text, looking it up in the LRU memo first.
+
+        Args:
+            text (str): The input text.
+
+        Returns:
+            str: The cleaned text.
+        """
+        key = hashlib.blake2b(
+            text.encode("utf-8", "surrogatepass"), digest_size=16, key=self._config_key
+        ).digest()
+        memo = self._memo
+        cleaned = memo.get(key)
+        if cleaned is not None:
+            memo.move_to_end(key)
+            self.memo_hits += 1
+            return cleaned
+        self.memo_misses += 1
+        cleaned = self._clean_compiled(text) if self.compiled else self._clean_steps(text)
+        memo[key] = cleaned
+        if len(memo) > self.memo_size:
+            memo.popitem(last=False)
+        return cleaned
+
+    def memo_hit_rate(self):
+        """
+        Returns:
+            float: Share of the lines cleaned since the creation of the cleaner that were found in the memo.
+        """
+        total = self.memo_hits + self.memo_misses
+        return self.memo_hits / total if total else 0.0
@@ -0,0 +1,223 @@
+"""
+Module: utils/token_corpus.py
+Description: Integer-encoded, memory-mapped corpus format for the corpus after the phrase stages.
+
+A token corpus is a folder with:
+    vocab.txt -- one word per line, the line number is the word ID
+    tokens.u32 -- flat uint32 array of the word IDs of all the sentences
+    sent_offsets.i64 -- int64 array, sentence i spans tokens[sent_offsets[i]:sent_offsets[i + 1]]
+    doc_offsets.i64 -- int64 array, document j spans sentences doc_offsets[j]:doc_offsets[j + 1]
+    doc_ids.txt -- one document ID per line
+The arrays are memory-mapped, so that several processes share the corpus through the page cache,
+and scoring / document frequencies run as NumPy operations instead of str.split on every document.
+"""
+
+import itertools
+from pathlib import Path
+
+import numpy as np
+
+from Utils import document_ids, file_process
+
+VOCAB_FILE = "vocab.txt"
+TOKENS_FILE = "tokens.u32"
+SENT_OFFSETS_FILE = "sent_offsets.i64"
+DOC_OFFSETS_FILE = "doc_offsets.i64"
+DOC_IDS_FILE = "doc_ids.txt"
+
+
+def _sentence_doc_keys(sent_id_file, int_ids):
+    """Document key of each sentence: the document index for integer sentence IDs,
+    the document ID for docID_sentenceID sentence IDs, None for a blank line (document without sentences)
+    """
+    if int_ids:
+        doc_index, _ = document_ids.read_sentence_ids(sent_id_file)
+        for i in doc_index:
+            yield int(i) if i >= 0 else None
+    else:
+        with file_process.open_file(sent_id_file, encoding="utf-8") as f:
+            for line in f:
+                yield line.strip().rsplit("_", 1)[0]
+
+
+def build_token_corpus(corpus_file, output_dir, sent_id_file=None, doc_id_file=None, block_size=1 << 22,
+                       int_ids=None):
+    """Encode a sentence corpus into a token corpus folder.
+    Consecutive sentences with the same document ID form a document.
+
+    Arguments:
+        corpus_file {str or Path} -- sentence corpus (e.g. the trigram corpus), each line is a sentence
+        output_dir {str or Path} -- folder of the token corpus, created if it does not exist
+
+    Keyword Arguments:
+        sent_id_file {str or Path} -- sentence ID file of the corpus; if None, each line is a document
+            and its line number is the document ID (default: {None})
+        doc_id_file {str or Path} -- document ID file, required for integer sentence IDs (default: {None})
+        block_size {int} -- number of tokens buffered before writing (default: {4M})
+        int_ids {bool} -- the sentence IDs are two integer columns, detected from the file if None
+            (see document_ids.is_int_sentence_id_file) (default: {None})
+
+    Returns:
+        TokenCorpus -- the encoded corpus
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    if sent_id_file is None:
+        keys = itertools.count()
+    else:
+        if int_ids is None:
+            int_ids = document_ids.is_int_sentence_id_file(sent_id_file)
+        keys = _sentence_doc_keys(sent_id_file, int_ids)
+    doc_id_table = document_ids.DocumentIds(doc_id_file) if doc_id_file is not None else None
+
+    vocab = {}
+    tokens = []
+    sent_offsets = [0]
+    doc_offsets = [0]
+    n_tokens = 0
+    previous_key = None
+    with file_process.open_file(corpus_file, encoding="utf-8") as f_corpus, \
+            open(output_dir / TOKENS_FILE, "wb") as f_tokens, \
+            open(output_dir / DOC_IDS_FILE, "w", encoding="utf-8", newline="\n") as f_doc_ids:
+        for key, line in zip(keys, f_corpus):
+            if key is None:
+                continue
+            if key != previous_key:
+                if len(sent_offsets) > 1:
+                    doc_offsets.append(len(sent_offsets) - 1)
+                if isinstance(key, int) and doc_id_table is not None:
+                    f_doc_ids.write(doc_id_table[key] + "\n")
+                else:
+                    f_doc_ids.write(str(key) + "\n")
+                previous_key = key
+            sentence = [vocab.setdefault(word, len(vocab)) for word in line.split()]
+            tokens.extend(sentence)
+            n_tokens += len(sentence)
+            sent_offsets.append(n_tokens)
+            if len(tokens) >= block_size:
+                np.asarray(tokens, dtype=np.uint32).tofile(f_tokens)
+                tokens = []
+        np.asarray(tokens, dtype=np.uint32).tofile(f_tokens)
+    if len(sent_offsets) > 1:
+        doc_offsets.append(len(sent_offsets) - 1)
+    if doc_id_table is not None:
+        doc_id_table.close()
+    np.asarray(sent_offsets, dtype=np.int64).tofile(output_dir / SENT_OFFSETS_FILE)
+    np.asarray(doc_offsets, dtype=np.int64).tofile(output_dir / DOC_OFFSETS_FILE)
+    file_process.list_to_file(list(vocab.keys()), output_dir / VOCAB_FILE)
+    file_process.build_line_index(output_dir / DOC_IDS_FILE)
+    print(
+        "Token corpus: {} documents, {} sentences, {} tokens, {} words in vocab.".format(
+            len(doc_offsets) - 1, len(sent_offsets) - 1, n_tokens, len(vocab)
+        )
+    )
+    return TokenCorpus(output_dir)
+
+
+def _memmap(a_file, dtype):
+    """Memory-map a flat array file, an empty file gives an empty array"""
+    if Path(a_file).stat().st_size == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(a_file, dtype=dtype, mode="r")
+
+
+class TokenCorpus:
+    """
+    A token corpus folder written by build_token_corpus, with memory-mapped arrays.
+    Iterating over it yields the sentences as lists of words, so that it can be used by gensim models.
+    """
+
+    def __init__(self, corpus_dir):
+        """
+        Args:
+            corpus_dir (str or Path): Folder of the token corpus.
+        """
+        self.corpus_dir = Path(corpus_dir)
+        self.vocab = file_process.file_to_list(self.corpus_dir / VOCAB_FILE)
+        self.word_to_id = {word: i for i, word in enumerate(self.vocab)}
+        self.tokens = _memmap(self.corpus_dir / TOKENS_FILE, np.uint32)
+        self.sent_offsets = _memmap(self.corpus_dir / SENT_OFFSETS_FILE, np.int64)
+        self.doc_offsets = _memmap(self.corpus_dir / DOC_OFFSETS_FILE, np.int64)
+        self.doc_ids = document_ids.DocumentIds(self.corpus_dir / DOC_IDS_FILE)
+
+    @property
+    def n_sentences(self):
+        return len(self.sent_offsets) - 1
+
+    @property
+    def n_documents(self):
+        return max(len(self.doc_offsets) - 1, 0)
+
+    def __iter__(self):
+        vocab = self.vocab
+        for i in range(self.n_sentences):
+            sentence = self.tokens[self.sent_offsets[i]: self.sent_offsets[i + 1]]
+            if len(sentence):
+                yield [vocab[t] for t in sentence]
+
+    def sentence(self, i):
+        """Word IDs of sentence i"""
+        return np.asarray(self.tokens[self.sent_offsets[i]: self.sent_offsets[i + 1]])
+
+    def document(self, j):
+        """Word IDs of document j"""
+        doc_token_offsets = self.document_token_offsets()
+        return np.asarray(self.tokens[doc_token_offsets[j]: doc_token_offsets[j + 1]])
+
+    def document_token_offsets(self):
+        """Token offsets of the documents, document j spans tokens[offsets[j]:offsets[j + 1]]"""
+        return np.asarray(self.sent_offsets)[np.asarray(self.doc_offsets)]
+
+    def document_lengths(self):
+        """Number of tokens in each document"""
+        return np.diff(self.document_token_offsets())
+
+    def word_ids(self, words):
+        """IDs of the words that are in the vocab"""
+        return np.array(
+            [self.word_to_id[w] for w in words if w in self.word_to_id], dtype=np.uint32
+        )
+
+    def document_frequency(self, block_size=1 << 24):
+        """Number of documents that contain each word
+
+        Keyword Arguments:
+            block_size {int} -- approximate number of tokens processed at once, bounds the memory (default: {16M})
+
+        Returns:
+            numpy.ndarray -- int64 array indexed by word ID
+        """
+        n_vocab = len(self.vocab)
+        df = np.zeros(n_vocab, dtype=np.int64)
+        doc_token_offsets = self.document_token_offsets()
+        lengths = np.diff(doc_token_offsets)
+        start = 0
+        while start < self.n_documents:
+            # documents start:end have about block_size tokens (at least one document)
+            end = int(np.searchsorted(doc_token_offsets, doc_token_offsets[start] + block_size, side="right"))
+            end = min(max(end - 1, start + 1), self.n_documents)
+            block = np.asarray(
+                self.tokens[doc_token_offsets[start]: doc_token_offsets[end]], dtype=np.int64
+            )
+            local_doc = np.repeat(np.arange(end - start, dtype=np.int64), lengths[start:end])
+            unique_pairs = np.unique(local_doc * n_vocab + block)
+            df += np.bincount(unique_pairs % n_vocab, minlength=n_vocab)
+            start = end
+        return df
+
+    def document_word_counts(self, word_ids):
+        """Count the occurrences of some words in each document
+
+        Arguments:
+            word_ids {numpy.ndarray} -- IDs of the words to count
+
+        Returns:
+            numpy.ndarray, numpy.ndarray, numpy.ndarray -- document indices, word IDs and counts
+                of each (document, word) pair that occurs at least once
+        """
+        n_vocab = len(self.vocab)
+        positions = np.flatnonzero(np.isin(self.tokens, word_ids))
+        docs = np.searchsorted(self.document_token_offsets(), positions, side="right") - 1
+        pairs = docs.astype(np.int64) * n_vocab + np.asarray(self.tokens[positions], dtype=np.int64)
+        unique_pairs, counts = np.unique(pairs, return_counts=True)
+        return unique_pairs // n_vocab, unique_pairs % n_vocab, counts
@@ -1,52 +1,575 @@
 import gensim
+import global_options
+import numpy as np
+import pandas as pd
 from gensim.corpora import Dictionary
+from gensim.models.callbacks import CallbackAny2Vec
 from pathlib import Path
+import functools
+import inspect
+import json
 import os
+import pickle
+import re
+import tempfile
+import time
+from Utils import file_process, token_corpus
 
 
-def train_w2v_model(input_path, model_path, *args, **kwargs):
+def _sentences(input_path):
+    """Iterable of the sentences (lists of words) of a corpus file, of a token corpus folder,
+    or of the corpus files of a folder"""
+    if Path(input_path, token_corpus.TOKENS_FILE).exists():
+        return token_corpus.TokenCorpus(input_path)
+    return file_process.LineSentences(input_path, max_sentence_length=10000000)
+
+
+class EpochLogger(CallbackAny2Vec):
+    """Print the duration and the words/sec of each training epoch.
+
+    The effective words are the words trained on after min_count and downsampling; gensim does not pass their count
+    to the callbacks, so it is estimated from the vocab counts and the downsampling probabilities.
+    The raw words are the words of the corpus.
+    """
+
+    def __init__(self):
+        self.epoch = 0
+        self.start_time = None
+        self.effective_words = None
+
+    def on_train_begin(self, model):
+        try:
+            counts = model.wv.expandos["count"]
+            sample_ints = model.wv.expandos["sample_int"]
+        except KeyError:
+            self.effective_words = None
+        else:
+            self.effective_words = float(np.sum(counts * np.minimum(sample_ints / 2 ** 32, 1.0)))
+
+    def on_epoch_begin(self, model):
+        self.start_time = time.perf_counter()
+
+    def on_epoch_end(self, model):
+        elapsed = time.perf_counter() - self.start_time
+        raw_words = model.corpus_total_words or 0
+        self.epoch += 1
+        if elapsed <= 0:
+            elapsed = float("nan")
+        if self.effective_words is None:
+            print("Epoch {}: {:.1f}s, {:.0f} raw words/sec.".format(self.epoch, elapsed, raw_words / elapsed))
+        else:
+            print(
+                "Epoch {}: {:.1f}s, ~{:.0f} effective words/sec ({:.0f} raw words/sec).".format(
+                    self.epoch, elapsed, self.effective_words / elapsed, raw_words / elapsed
+                )
+            )
+
+
+def _source_stamp(input_path):
+    """Size and modification time of a corpus file or token corpus folder, to check that a conversion is current"""
+    input_path = Path(input_path)
+    files = sorted(input_path.iterdir()) if input_path.is_dir() else [input_path]
+    return {
+        "source": str(input_path),
+        "size": sum(f.stat().st_size for f in files),
+        "mtime": max(f.stat().st_mtime for f in files),
+    }
+
+
+def line_sentence_file(input_path, converted_path):
+    """ Get a corpus in the LineSentence format of gensim's corpus_file mode: a plain text file,
+    each line is a sentence of words separated by single spaces.
+    A plain corpus file is already in this format and is used as is. A compressed corpus, a folder of corpus
+    files or a token corpus folder is converted to converted_path, unless the conversion is current (same size and modification
+    time of the source, recorded next to the converted file).
+
+    Arguments:
+        input_path {str or Path} -- corpus file (can be compressed), folder of corpus files or token corpus folder
+        converted_path {str or Path} -- where to write the converted corpus if needed
+
+    Returns:
+        Path -- the LineSentence file
+    """
+    input_path = Path(input_path)
+    if not input_path.is_dir() and not file_process.is_compressed(input_path):
+        return input_path
+    converted_path = Path(converted_path)
+    stamp_path = Path(str(converted_path) + ".source.json")
+    stamp = _source_stamp(input_path)
+    try:
+        with open(stamp_path, encoding="utf-8") as f:
+            if json.load(f) == stamp and converted_path.exists():
+                print("{} is current.".format(converted_path))
+                return converted_path
+    except (OSError, ValueError):
+        pass
+    print("Converting {} to {}...".format(input_path, converted_path))
+    converted_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(converted_path, "w", encoding="utf-8", newline="\n") as f:
+        for sentence in _sentences(input_path):
+            f.write(" ".join(sentence) + "\n")
+    with open(stamp_path, "w", encoding="utf-8") as f:
+        json.dump(stamp, f)
+    return converted_path
+
+
+def train_w2v_model(input_path, model_path, *args, corpus_file=True, **kwargs):
     """ Train a word2vec model using the LineSentence file in input_path,
     save the model to model_path.count
+    The words/sec of each epoch are printed.
 
     Arguments:
-        input_path {str} -- Corpus for training, each line is a sentence
+        input_path {str} -- Corpus for training, each line is a sentence (can be compressed, see file_process.open_file),
+            or a token corpus folder (see token_corpus.build_token_corpus)
         model_path {str} -- Where to save the model?
+
+    Keyword Arguments:
+        corpus_file {bool} -- train with gensim's corpus_file mode, in which each worker reads its own part of the
+            file, instead of a single thread feeding the sentences to the workers; a compressed corpus or a token
+            corpus is first converted to a LineSentence file next to the model (default: {True})
+    """
+    Path(model_path).parent.mkdir(parents=True, exist_ok=True)
+    callbacks = list(kwargs.pop("callbacks", [])) + [EpochLogger()]
+    if corpus_file:
+        corpus_path = line_sentence_file(input_path, Path(model_path).parent / "w2v_corpus.txt")
+        model = gensim.models.Word2Vec(*args, corpus_file=str(corpus_path), callbacks=callbacks, **kwargs)
+    else:
+        corpus_confcall = _sentences(input_path)
+        model = gensim.models.Word2Vec(corpus_confcall, *args, callbacks=callbacks, **kwargs)
+    model.save(str(model_path))
+
+
+def scan_w2v_vocab(input_path, vocab_path):
+    """ Count the words of a corpus once, so that several word2vec models can be trained on it
+    without scanning it again (see train_w2v_from_vocab). The raw counts do not depend on the
+    training parameters, min_count and sample are applied when a model is built from them.
+
+    Arguments:
+        input_path {str or Path} -- LineSentence corpus file (see line_sentence_file)
+        vocab_path {str or Path} -- where to save the raw word counts and the number of sentences (pickle)
+
+    Returns:
+        Path -- vocab_path
+    """
+    Path(vocab_path).parent.mkdir(parents=True, exist_ok=True)
+    model = gensim.models.Word2Vec()
+    total_words, corpus_count = model.scan_vocab(corpus_file=str(input_path))
+    with open(vocab_path, "wb") as f:
+        pickle.dump({"raw_vocab": dict(model.raw_vocab), "corpus_count": corpus_count, "total_words": total_words}, f)
+    print("Vocab scanned: {} words in {} sentences.".format(len(model.raw_vocab), corpus_count))
+    return Path(vocab_path)
+
+
+def train_w2v_from_vocab(input_path, vocab_path, model_path, *args, **kwargs):
+    """ Train a word2vec model in corpus_file mode on the raw word counts of scan_w2v_vocab instead of
+    scanning the corpus, and save the model to model_path. The model is the same as train_w2v_model's.
+
+    Arguments:
+        input_path {str or Path} -- LineSentence corpus file the counts were scanned from
+        vocab_path {str or Path} -- raw word counts saved by scan_w2v_vocab
+        model_path {str or Path} -- Where to save the model?
+
+    Additional arguments (*args and **kwargs) are passed to the Word2Vec constructor.
+
+    Returns:
+        gensim.models.Word2Vec -- the trained model
     """
     Path(model_path).parent.mkdir(parents=True, exist_ok=True)
-    corpus_confcall = gensim.models.word2vec.PathLineSentences(
-        str(input_path), max_sentence_length=10000000
+    with open(vocab_path, "rb") as f:
+        vocab = pickle.load(f)
+    callbacks = list(kwargs.pop("callbacks", [])) + [EpochLogger()]
+    model = gensim.models.Word2Vec(*args, **kwargs)
+    model.build_vocab_from_freq(vocab["raw_vocab"], corpus_count=vocab["corpus_count"])
+    model.corpus_total_words = vocab["total_words"]
+    model.train(
+        corpus_file=str(input_path),
+        total_examples=model.corpus_count,
+        total_words=model.corpus_total_words,
+        epochs=model.epochs,
+        callbacks=callbacks,
     )
-    model = gensim.models.Word2Vec(corpus_confcall, *args, **kwargs)
     model.save(str(model_path))
+    return model
+
+
+def _next_version_path(model_path):
+    """Path of the next version of a model: w2v.mod or any of its versions -> w2v.v1.mod, w2v.v2.mod, ..."""
+    model_path = Path(model_path)
+    stem = re.sub(r"\.v\d+$", "", model_path.stem)
+    pattern = re.compile(re.escape(stem) + r"\.v(\d+)" + re.escape(model_path.suffix) + "$")
+    versions = [int(m.group(1)) for m in (pattern.match(f.name) for f in model_path.parent.iterdir()) if m]
+    return model_path.with_name("{}.v{}{}".format(stem, max(versions, default=0) + 1, model_path.suffix))
 
 
-def train_lda_model(input_path, model_path, *args, **kwargs):
+def _seed_neighbourhoods(model, seed_words, n):
+    """The n words closest to the mean vector of the seed words of each dimension, as in
+    dictionary.expand_words_dimension_mean
+
+    Returns:
+        dict[str, set] -- {dimension: set([words])}, without the dimensions with no seed word in the vocab
+    """
+    neighbourhoods = {}
+    for dimension, words in seed_words.items():
+        words = [w for w in words if w in model.wv.key_to_index]
+        if words:
+            neighbourhoods[dimension] = {w for w, _ in model.wv.most_similar(words, topn=n)}
+    return neighbourhoods
+
+
+def update_w2v_model(model_path, delta_path, output_path=None, seed_words=None, n_neighbours=None, epochs=None):
+    """ Update a trained word2vec model with new sentences instead of training it again on the whole corpus:
+    the vocab is extended with the words of the delta corpus (build_vocab(update=True)) and the model is
+    trained on the delta corpus only. The updated model is saved as a new version next to the old one,
+    with drift statistics of the seed word neighbourhoods used by creat_dictionary.creat_dict.
+
+    Arguments:
+        model_path {str or Path} -- trained model, e.g. w2v.mod or its latest version
+        delta_path {str or Path} -- new sentences, each line is a sentence (can be compressed) or a token corpus folder
+
+    Keyword Arguments:
+        output_path {str or Path} -- where to save the updated model, the next version of model_path
+            (w2v.v1.mod, w2v.v2.mod, ...) if None (default: {None})
+        seed_words {dict[str, list]} -- seed words of each dimension (default: {global_options.SEED_WORDS})
+        n_neighbours {int} -- number of closest words in each neighbourhood (default: {global_options.N_WORDS_DIM})
+        epochs {int} -- number of epochs over the delta corpus, the epochs of the model if None (default: {None})
+
+    Returns:
+        Path, pandas.DataFrame -- the updated model and its drift statistics, one row per dimension:
+            neighbourhood_jaccard (overlap of the neighbourhoods before and after the update),
+            new_neighbours (words that entered the neighbourhood), seed_cosine (mean cosine similarity
+            of each seed word vector before and after the update); also saved as <output_path>.drift.csv
+    """
+    if seed_words is None:
+        seed_words = global_options.SEED_WORDS
+    if n_neighbours is None:
+        n_neighbours = global_options.N_WORDS_DIM
+    output_path = Path(output_path) if output_path is not None else _next_version_path(model_path)
+    model = gensim.models.Word2Vec.load(str(model_path))
+    neighbourhoods_before = _seed_neighbourhoods(model, seed_words, n_neighbours)
+    seeds_before = {
+        w: model.wv[w].copy() for words in seed_words.values() for w in words if w in model.wv.key_to_index
+    }
+    n_vocab_before = len(model.wv.key_to_index)
+
+    delta_file = line_sentence_file(delta_path, output_path.parent / "w2v_delta_corpus.txt")
+    model.build_vocab(corpus_file=str(delta_file), update=True)
+    print("Vocab: {} words, {} new.".format(len(model.wv.key_to_index), len(model.wv.key_to_index) - n_vocab_before))
+    model.train(
+        corpus_file=str(delta_file),
+        total_examples=model.corpus_count,
+        total_words=model.corpus_total_words,
+        epochs=epochs if epochs is not None else model.epochs,
+        callbacks=[EpochLogger()],
+    )
+    model.save(str(output_path))
+    print("Updated model saved at {}".format(output_path))
+
+    neighbourhoods_after = _seed_neighbourhoods(model, seed_words, n_neighbours)
+    rows = []
+    for dimension, before in neighbourhoods_before.items():
+        after = neighbourhoods_after.get(dimension, set())
+        seed_cosines = [
+            float(np.dot(vector, model.wv[w]) / (np.linalg.norm(vector) * np.linalg.norm(model.wv[w])))
+            for w, vector in seeds_before.items()
+            if w in seed_words[dimension]
+        ]
+        rows.append({
+            "dimension": dimension,
+            "neighbourhood_jaccard": len(before & after) / len(before | after) if before | after else 1.0,
+            "new_neighbours": len(after - before),
+            "seed_cosine": float(np.mean(seed_cosines)) if seed_cosines else float("nan"),
+        })
+    drift = pd.DataFrame(rows, columns=["dimension", "neighbourhood_jaccard", "new_neighbours", "seed_cosine"])
+    drift.to_csv(str(output_path) + ".drift.csv", index=False)
+    print(drift.to_string(index=False))
+    return output_path, drift
+
+
+BOW_DICTIONARY_FILE = "dictionary.dict"
+BOW_CORPUS_FILE = "corpus.mm"
+BOW_STAMP_FILE = "bow.json"
+
+
+def serialize_bow_corpus(input_path, bow_dir, no_below=None, no_above=None, keep_n=None):
+    """ Build the dictionary of a corpus and serialize its bag-of-words vectors to a Matrix Market file,
+    streaming over the corpus twice, so that the memory does not grow with the corpus. The serialized corpus
+    is reused while the source corpus and the filter settings do not change (see _source_stamp).
+
+    Arguments:
+        input_path {str or Path} -- Corpus, each line is a document (can be compressed), or a token corpus folder
+        bow_dir {str or Path} -- folder of the dictionary (dictionary.dict) and the corpus (corpus.mm)
+
+    Keyword Arguments:
+        no_below {int} -- drop the words in fewer documents, see Dictionary.filter_extremes (default: {None}, no filter)
+        no_above {float} -- drop the words in a larger fraction of the documents (default: {None}, no filter)
+        keep_n {int} -- keep only the most frequent words after the two filters above (default: {None}, all)
+
+    Returns:
+        gensim.corpora.Dictionary, gensim.corpora.MmCorpus -- the dictionary and the corpus, read from disk
+            document by document
+    """
+    bow_dir = Path(bow_dir)
+    bow_dir.mkdir(parents=True, exist_ok=True)
+    dictionary_path = bow_dir / BOW_DICTIONARY_FILE
+    corpus_path = bow_dir / BOW_CORPUS_FILE
+    stamp_path = bow_dir / BOW_STAMP_FILE
+    stamp = dict(_source_stamp(input_path), no_below=no_below, no_above=no_above, keep_n=keep_n)
+    try:
+        with open(stamp_path, encoding="utf-8") as f:
+            if json.load(f) == stamp and dictionary_path.exists() and corpus_path.exists():
+                print("{} is current.".format(corpus_path))
+                return Dictionary.load(str(dictionary_path)), gensim.corpora.MmCorpus(str(corpus_path))
+    except (OSError, ValueError):
+        pass
+    stamp_path.unlink(missing_ok=True)
+
+    documents = _sentences(input_path)
+    print("Building the dictionary of {}...".format(input_path))
+    dictionary = Dictionary(documents)
+    if no_below is not None or no_above is not None or keep_n is not None:
+        # same defaults as filter_extremes for the settings that are not given
+        dictionary.filter_extremes(
+            no_below=no_below if no_below is not None else 1,
+            no_above=no_above if no_above is not None else 1.0,
+            keep_n=keep_n,
+        )
+    print("Dictionary: {} words in {} documents.".format(len(dictionary), dictionary.num_docs))
+    dictionary.save(str(dictionary_path))
+    print("Serializing the bag-of-words corpus to {}...".format(corpus_path))
+    gensim.corpora.MmCorpus.serialize(
+        str(corpus_path), (dictionary.doc2bow(doc) for doc in documents), id2word=dictionary
+    )
+    with open(stamp_path, "w", encoding="utf-8") as f:
+        json.dump(stamp, f)
+    return dictionary, gensim.corpora.MmCorpus(str(corpus_path))
+
+
+def train_lda_model(input_path, model_path, *args, bow_dir=None, no_below=None, no_above=None, keep_n=None,
+                    workers=None, **kwargs):
     """
     Train an LDA model using the corpus at input_path and save it to model_path.
+    The bag-of-words corpus is serialized once (see serialize_bow_corpus) and streamed from disk,
+    so that models with different numbers of topics are trained on the same serialized corpus.
 
     Arguments:
-        input_path {str or Path} -- Corpus for training, each line is a sentence
+        input_path {str or Path} -- Corpus for training, each line is a sentence, or a token corpus folder
         model_path {str or Path} -- Where to save the model?
         num_topics {int} -- Number of topics to be extracted by the LDA model.
 
-    Additional arguments (*args and **kwargs) can be passed to the LdaModel constructor.
+    Keyword Arguments:
+        bow_dir {str or Path} -- folder of the serialized corpus (default: {"bow" next to the model})
+        no_below, no_above, keep_n -- filters of the dictionary, see serialize_bow_corpus (default: {None})
+        workers {int} -- number of worker processes of LdaMulticore; 1 trains the single-process LdaModel,
+            e.g. for alpha="auto" which LdaMulticore does not support (default: {global_options.N_CORES - 1})
+
+    Additional arguments (*args and **kwargs) can be passed to the LdaMulticore (or LdaModel) constructor.
     """
     Path(model_path).parent.mkdir(parents=True, exist_ok=True)
-    documents = gensim.models.word2vec.PathLineSentences(
-        str(input_path), max_sentence_length=10000000
+    if bow_dir is None:
+        bow_dir = Path(model_path).parent / "bow"
+    if workers is None:
+        workers = max(global_options.N_CORES - 1, 1)
+    dictionary, corpus = serialize_bow_corpus(
+        input_path, bow_dir, no_below=no_below, no_above=no_above, keep_n=keep_n
     )
-    dictionary = Dictionary(documents)
-    corpus_politic = [dictionary.doc2bow(doc) for doc in documents]
 
-    lda_model = gensim.models.ldamodel.LdaModel(
-        corpus_politic, id2word=dictionary, *args, **kwargs
-    )
+    if workers == 1:
+        lda_model = gensim.models.ldamodel.LdaModel(corpus, id2word=dictionary, *args, **kwargs)
+    else:
+        lda_model = gensim.models.ldamulticore.LdaMulticore(
+            corpus, id2word=dictionary, workers=workers, *args, **kwargs
+        )
 
     lda_model.save(str(model_path))
     return lda_model
 
 
-def tf_idf_keywords(folder_path, document_path, num_keywords=500, *args, **kwargs):
+TFIDF_DICTIONARY_FILE = "dictionary.dict"
+TFIDF_MODEL_FILE = "tfidf.mod"
+TFIDF_STAMP_FILE = "tfidf.json"
+
+
+def _tfidf_documents(input_path):
+    """Documents (lists of words) of a folder of .txt files (one document per file), of a token corpus folder,
+    or of a corpus file (one document per line)"""
+    input_path = Path(input_path)
+    if input_path.is_dir() and not (input_path / token_corpus.TOKENS_FILE).exists():
+        for filename in sorted(os.listdir(input_path)):
+            if filename.endswith(".txt"):
+                with open(input_path / filename, 'r', encoding='utf-8') as file:
+                    yield file.read().split()
+    else:
+        yield from _sentences(input_path)
+
+
+def fit_tfidf_model(input_path, model_dir, *args, no_below=None, no_above=None, keep_n=None, **kwargs):
+    """ Fit a TF-IDF model in one streaming pass over the documents and save it with its dictionary,
+    for keyword extraction with tfidf_keywords_many / file_tfidf_keywords. The document frequencies are
+    collected by the Dictionary, so that the TfidfModel is built from them without another pass.
+    The saved model is reused while the documents and the settings do not change (see _source_stamp).
+
+    Arguments:
+        input_path {str or Path} -- a folder of .txt files (one document per file), or a corpus file
+            (one document per line, can be compressed), or a token corpus folder
+        model_dir {str or Path} -- folder of the dictionary (dictionary.dict) and the model (tfidf.mod)
+
+    Keyword Arguments:
+        no_below, no_above, keep_n -- filters of the dictionary, see serialize_bow_corpus (default: {None})
+
+    Additional arguments (*args and **kwargs) can be passed to the TfidfModel constructor, *args after the corpus;
+    id2word and dictionary are ignored, the model uses the fitted dictionary.
+
+    Returns:
+        gensim.corpora.Dictionary, gensim.models.TfidfModel -- the dictionary and the model
+    """
+    model_dir = Path(model_dir)
+    model_dir.mkdir(parents=True, exist_ok=True)
+    dictionary_path = model_dir / TFIDF_DICTIONARY_FILE
+    model_path = model_dir / TFIDF_MODEL_FILE
+    stamp_path = model_dir / TFIDF_STAMP_FILE
+    tfidf_params = inspect.signature(gensim.models.TfidfModel).bind_partial(None, *args, **kwargs).arguments
+    for name in ("corpus", "id2word", "dictionary"):
+        tfidf_params.pop(name, None)
+    stamp = dict(
+        _source_stamp(input_path), no_below=no_below, no_above=no_above, keep_n=keep_n,
+        params=json.loads(json.dumps(tfidf_params, default=str)),
+    )
+    try:
+        with open(stamp_path, encoding="utf-8") as f:
+            if json.load(f) == stamp and dictionary_path.exists() and model_path.exists():
+                print("{} is current.".format(model_path))
+                return load_tfidf_model(model_dir)
+    except (OSError, ValueError):
+        pass
+    stamp_path.unlink(missing_ok=True)
+
+    dictionary = Dictionary(_tfidf_documents(input_path))
+    if no_below is not None or no_above is not None or keep_n is not None:
+        dictionary.filter_extremes(
+            no_below=no_below if no_below is not None else 1,
+            no_above=no_above if no_above is not None else 1.0,
+            keep_n=keep_n,
+        )
+    # no corpus, the document frequencies are taken from the dictionary
+    tfidf = gensim.models.TfidfModel(dictionary=dictionary, **tfidf_params)
+    dictionary.save(str(dictionary_path))
+    tfidf.save(str(model_path))
+    with open(stamp_path, "w", encoding="utf-8") as f:
+        json.dump(stamp, f)
+    print("TF-IDF model: {} words in {} documents, saved at {}".format(len(dictionary), dictionary.num_docs, model_dir))
+    return dictionary, tfidf
+
+
+def load_tfidf_model(model_dir):
+    """
+    Arguments:
+        model_dir {str or Path} -- folder of a model saved by fit_tfidf_model
+
+    Returns:
+        gensim.corpora.Dictionary, gensim.models.TfidfModel -- the dictionary and the model
+    """
+    return (
+        Dictionary.load(str(Path(model_dir, TFIDF_DICTIONARY_FILE))),
+        gensim.models.TfidfModel.load(str(Path(model_dir, TFIDF_MODEL_FILE))),
+    )
+
+
+def _top_keywords(dictionary, tfidf, document, num_keywords):
+    """Top num_keywords (word, score) of a document (list of words), by decreasing score.
+    The num_keywords-th score is found with a partial sort (partition) and only the scores up to it are sorted."""
+    doc_tfidf = tfidf[dictionary.doc2bow(document)]
+    if not doc_tfidf:
+        return []
+    word_ids = np.fromiter((word_id for word_id, _ in doc_tfidf), dtype=np.int64, count=len(doc_tfidf))
+    scores = np.fromiter((score for _, score in doc_tfidf), dtype=np.float64, count=len(doc_tfidf))
+    if 0 < num_keywords < len(scores):
+        # all the scores tied with the last one kept, in the order of the words
+        cutoff = -np.partition(-scores, num_keywords - 1)[num_keywords - 1]
+        top = np.flatnonzero(scores >= cutoff)
+    else:
+        top = np.arange(len(scores))
+    # stable, so that ties keep the order of the words as sorted() does, also at the cutoff
+    top = top[np.argsort(-scores[top], kind="stable")][:num_keywords]
+    return [(dictionary[int(word_ids[i])], float(scores[i])) for i in top]
+
+
+def tfidf_keywords_many(model_dir, documents, num_keywords=500):
+    """ Extract the top keywords of many documents with a saved TF-IDF model.
+
+    Arguments:
+        model_dir {str or Path} -- folder of a model saved by fit_tfidf_model
+        documents {iterable} -- documents, each a string or a list of words
+
+    Keyword Arguments:
+        num_keywords {int} -- Number of top keywords to extract from each document (default: {500})
+
+    Yields:
+        [(str, float)] -- the keywords of each document and their TF-IDF scores, by decreasing score
+    """
+    dictionary, tfidf = load_tfidf_model(model_dir)
+    for document in documents:
+        if isinstance(document, str):
+            document = document.split()
+        yield _top_keywords(dictionary, tfidf, document, num_keywords)
+
+
+def _line_keyworder(model_dir, num_keywords):
+    """Build the batch function used by file_process.process_large_file to extract keywords.
+    The model is loaded here, so that each worker process loads it once.
+
+    Returns:
+        callable -- keywords_lines(lines, line_ids)
+    """
+    dictionary, tfidf = load_tfidf_model(model_dir)
+
+    def keywords_lines(lines, line_ids):
+        return [
+            " ".join("{}:{:.6g}".format(word, score)
+                     for word, score in _top_keywords(dictionary, tfidf, line.split(), num_keywords))
+            for line in lines
+        ], line_ids
+
+    return keywords_lines
+
+
+def file_tfidf_keywords(input_path, output_path, model_dir, num_keywords=500, workers=1, chunk_size=20000,
+                        resume=False, pipeline=False):
+    """ Extract the top keywords of every document (line) of a corpus file with a saved TF-IDF model,
+    streaming the file in chunks through the worker processes.
+
+    Arguments:
+        input_path {str}: Each line is a document
+        output_path {str}: Each line is the keywords of the document, "word:score" separated by spaces,
+            by decreasing score
+        Both files can be compressed, chosen by the extension (see file_process.open_file)
+        model_dir {str}: Folder of a model saved by fit_tfidf_model
+        num_keywords {int}: Number of top keywords to extract from each document (default: 500)
+        workers {int}: Number of processes (default: 1)
+        chunk_size {int}: Number of lines sent to a process at once (default: 20000)
+        resume {bool}: Continue an interrupted run from its checkpoint manifest (default: False)
+        pipeline {bool}: Overlap reading, extracting and writing with bounded queues (default: False)
+    """
+    Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+    file_process.process_large_file(
+        input_file=input_path,
+        output_file=output_path,
+        input_file_ids=None,
+        output_index_file=None,
+        function_factory=functools.partial(_line_keyworder, model_dir=str(model_dir), num_keywords=num_keywords),
+        chunk_size=chunk_size,
+        workers=workers,
+        resume=resume,
+        pipeline=pipeline,
+        batched=True,
+        params={
+            "stage": "tfidf_keywords",
+            "model": [str(model_dir), Path(model_dir, TFIDF_MODEL_FILE).stat().st_mtime],
+            "num_keywords": num_keywords,
+        },
+    )
+
+
+def tf_idf_keywords(folder_path, document_path, num_keywords=500, *args, model_dir=None, **kwargs):
     """
     Train a TF-IDF model using documents in a specified folder and then extract keywords
     from a specified document.
@@ -55,36 +578,22 @@ def tf_idf_keywords(folder_path, document_path, num_keywords=500, *args, **kwarg
         folder_path {str or Path} -- Path to the folder containing documents for training.
         document_path {str or Path} -- Path to the document for keyword extraction.
         num_keywords {int} -- Number of top keywords to extract.
-    """
-    # Read and preprocess documents from the folder
-    documents = []
-    for filename in os.listdir(folder_path):
-        if filename.endswith(".txt"):
-            with open(Path(folder_path) / filename, 'r', encoding='utf-8') as file:
-                documents.append(file.read().split())
 
-    # Create a dictionary and corpus for the TF-IDF model
-    dictionary = Dictionary(documents)
-    corpus = [dictionary.doc2bow(doc) for doc in documents]
+    Additional arguments (*args and **kwargs) can be passed to the TfidfModel constructor.
 
-    # Train the TF-IDF model
-    tfidf = gensim.models.TfidfModel(
-        corpus, *args, **kwargs
-    )
+    Keyword Arguments:
+        model_dir {str or Path} -- where to save the fitted model, and reuse it while the folder does not change
+            (see fit_tfidf_model); the model is fitted in a temporary folder if None (default: {None})
+    """
+    if model_dir is None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dictionary, tfidf = fit_tfidf_model(folder_path, tmp_dir, *args, **kwargs)
+    else:
+        dictionary, tfidf = fit_tfidf_model(folder_path, model_dir, *args, **kwargs)
 
     # Read the specified document
     with open(document_path, 'r', encoding='utf-8') as file:
         document = file.read().split()
 
-    # Convert the document to the bag-of-words format
-    doc_bow = dictionary.doc2bow(document)
-
-    # Apply the TF-IDF model to the document
-    doc_tfidf = tfidf[doc_bow]
-
-    # Sort the words by their TF-IDF score
-    sorted_keywords = sorted(doc_tfidf, key=lambda kv: kv[1], reverse=True)
-
     # Extract the top N keywords
-    keywords = [(dictionary[word_id], score) for word_id, score in sorted_keywords[:num_keywords]]
-    return keywords
\ No newline at end of file
+    return _top_keywords(dictionary, tfidf, document, num_keywords)
@@ -3,19 +3,50 @@ Module: clean.py
 Description: Main file that integrates the TextCleaner from utils/clean.py to process an entire corpus.
 """
 
+import functools
+import multiprocessing
 import global_options
 from pathlib import Path
 from Utils import file_process
 from Utils.text_cleaning import TextCleaner
 
 
-def clean_file(input_path, output_path, **kwargs):
+def _line_cleaner(memo_counters=None, **kwargs):
+    """
+    Build the batch function used by file_process.process_large_file to clean lines.
+
+    Args:
+        memo_counters (tuple of multiprocessing.Value, optional): Shared hit and miss counters of the memo,
+                                                                  updated after each batch.
+        **kwargs: Keyword arguments to configure the TextCleaner.
+
+    Returns:
+        callable: A function that takes a batch of lines and their IDs and returns the cleaned lines and the IDs.
+    """
+    a_text_cleaner = TextCleaner(**kwargs)
+
+    def clean_lines(lines, line_ids):
+        cleaned = a_text_cleaner.clean_many(lines)
+        if memo_counters is not None:
+            for counter, attribute in zip(memo_counters, ("memo_hits", "memo_misses")):
+                with counter.get_lock():
+                    counter.value += getattr(a_text_cleaner, attribute)
+                setattr(a_text_cleaner, attribute, 0)
+        return cleaned, line_ids
+
+    return clean_lines
+
+
+def clean_file(input_path, output_path, workers=1, resume=False, pipeline=False, **kwargs):
     """
     Clean the entire corpus (output from CoreNLP) line by line and write the cleaned text to an output file.
 
     Args:
         input_path (str or Path): Input corpus file, each line is a sentence.
         output_path (str or Path): Output corpus file.
+        workers (int): Number of processes used to clean the file. Default 1.
+        resume (bool): Continue an interrupted run from its checkpoint manifest. Default False.
+        pipeline (bool): Overlap reading, cleaning and writing with bounded queues. Default False.
         **kwargs: Additional keyword arguments to configure the TextCleaner.
                   For example:
                     - to_lower (bool): Convert text to lower case. Default True.
@@ -25,24 +56,37 @@ def clean_file(input_path, output_path, **kwargs):
                     - remove_single (bool): Remove single-character tokens. Default True.
                     - custom_stop (set, optional): Custom stopword set.
                     - language (str): Language for stopwords. Default 'english'.
+                    - memo_size (int): Size of the LRU memo of cleaned lines, the hit rate is printed at the end.
                   New parameters added in TextCleaner will be automatically accepted.
     """
-    # Initialize the TextCleaner with the desired cleaning options using **kwargs.
-    a_text_cleaner = TextCleaner(**kwargs)
-
-    # Count the number of lines in the input file to generate fake IDs.
-    total_lines = file_process.line_counter(input_path)
-    input_file_ids = [str(i) for i in range(total_lines)]
+    memo_counters = None
+    if kwargs.get("memo_size"):
+        memo_counters = (multiprocessing.Value("q", 0), multiprocessing.Value("q", 0))
+    # The memo does not change the output, keep it out of the checkpoint parameters.
+    params = {k: v for k, v in kwargs.items() if k != "memo_size"}
 
     # Process the input file in large chunks using the cleaning function.
     file_process.process_large_file(
         input_file=input_path,
         output_file=output_path,
-        input_file_ids=input_file_ids,  # Fake IDs, as they are not needed for this function.
+        input_file_ids=None,  # Line numbers are used as IDs, as they are not needed for this function.
         output_index_file=None,
-        function_name=lambda line, _id: (a_text_cleaner.clean(line), _id),
+        # The TextCleaner is initialized with the desired cleaning options once in each worker.
+        function_factory=functools.partial(_line_cleaner, memo_counters=memo_counters, **kwargs),
         chunk_size=20000,
+        workers=workers,
+        resume=resume,
+        pipeline=pipeline,
+        batched=True,
+        params={"stage": "clean", **params},
     )
+    if memo_counters is not None:
+        hits, misses = memo_counters[0].value, memo_counters[1].value
+        print(
+            "Clean memo: {} hits, {} misses, hit rate {:.1%}.".format(
+                hits, misses, hits / (hits + misses) if hits + misses else 0
+            )
+        )
 
 
 if __name__ == "__main__":
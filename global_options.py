@@ -11,6 +11,9 @@ from typing import Dict, List, Set
 N_CORES: int = 32  # max number of CPU cores to use
 RAM_CORENLP: str = "16G"  # max RAM allocated for parsing using CoreNLP; increase to speed up parsing
 PARSE_CHUNK_SIZE: int = 1000  # number of lines in the input file to process using CoreNLP at once. # Increase on workstations with larger RAM (e.g. to 1000 if RAM is 64G)
+CLEAN_MEMO_SIZE: int = 200000  # max number of cleaned lines memoized by the TextCleaner, repeated lines are cleaned once; 0 to disable
+DEDUP_THRESHOLD: float = None  # opt-in: parse near-duplicate documents once if their Jaccard similarity (MinHash/LSH) is above this, e.g. 0.9; lossy, the duplicates get the sentences of their representative
+PARSER_SOCKET: str = None  # Unix socket of a resident parse server (python -m Utils.parse_server), e.g. "/tmp/patience_parser.sock"; None to load the spaCy model in each run
 
 # Directory locations
 os.environ[
@@ -7,7 +7,7 @@ import clean
 import parse
 from creat_dictionary import creat_dict
 import global_options
-from Utils import train_models_untils, multiple_word_detect, file_process
+from Utils import train_models_untils, multiple_word_detect, file_process, token_corpus
 from score import run_scoring_pipeline
 
 logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
@@ -23,6 +23,9 @@ clean.clean_file(
     ),
     to_lower=True,
     remove_punc=True,
+    memo_size=global_options.CLEAN_MEMO_SIZE,
+    workers=global_options.N_CORES,
+    pipeline=True,
 )
 #%%
 # Parsing
@@ -30,16 +33,25 @@ parse.parse_document(
     input_path=Path(
         global_options.DATA_FOLDER, "Processed", "cleaned", "documents.txt"
     ),
-    input_id=file_process.file_to_list(Path(
+    input_id=Path(
         global_options.DATA_FOLDER, "Input", "document_ids.txt"
-    )),
+    ),
     output_path=Path(
         global_options.DATA_FOLDER, "processed", "parsed", "documents.txt"
     ),
     output_id=Path(
         global_options.DATA_FOLDER, "processed", "parsed", "document_sent_ids.txt"
     ),
-    lemma=True
+    workers=global_options.N_CORES,
+    pipeline=True,
+    batch=True,
+    cache_path=Path(
+        global_options.DATA_FOLDER, "processed", "parsed", "parse_cache.sqlite"
+    ),
+    dedup_threshold=global_options.DEDUP_THRESHOLD,
+    server=global_options.PARSER_SOCKET,
+    lemma=True,
+    single_pass=True
 )
 #%%
 # Final clean(e.g. remove punctuation and ner/pos tags)
@@ -56,11 +68,14 @@ clean.clean_file(
     remove_stop=True,
     remove_single=True,
     custom_stop=None,
-    language='english'
+    language='english',
+    memo_size=global_options.CLEAN_MEMO_SIZE,
+    workers=global_options.N_CORES,
+    pipeline=True,
 )
 
 #%%
-# train and apply a phrase model to detect 2-word phrases ----------------
+# train a phrase model to detect 2-word phrases ----------------
 multiple_word_detect.train_bigram_model(
     input_path=Path(
         global_options.DATA_FOLDER, "Processed", "unigram", "documents.txt"
@@ -68,42 +83,43 @@ multiple_word_detect.train_bigram_model(
     model_path=Path(
         global_options.MODEL_FOLDER, "phrases", "bigram.mod"
     ),
+    workers=global_options.N_CORES,
 )
 
-multiple_word_detect.file_bigramer(
-    input_path=Path(
-        global_options.DATA_FOLDER, "Processed", "unigram", "documents.txt"
-    ),
-    output_path=Path(
-        global_options.DATA_FOLDER, "Processed", "bigram", "documents.txt"
-    ),
-    model_path=Path(
-        global_options.MODEL_FOLDER, "phrases", "bigram.mod"
-    ),
-    scoring="npmi_scorer",
-    threshold=global_options.PHRASE_THRESHOLD,
-)
-
-# train and apply a phrase model to detect 3-word phrases ----------------
+# train a phrase model to detect 3-word phrases on the bigram sentences, built on the fly ----------------
 multiple_word_detect.train_bigram_model(
     input_path=Path(
-        global_options.DATA_FOLDER, "Processed", "bigram", "documents.txt"
+        global_options.DATA_FOLDER, "Processed", "unigram", "documents.txt"
     ),
     model_path=Path(
         global_options.MODEL_FOLDER, "phrases", "trigram.mod"
     ),
+    workers=global_options.N_CORES,
+    input_phrases=[
+        multiple_word_detect.export_frozen_phrases(
+            Path(global_options.MODEL_FOLDER, "phrases", "bigram.mod"),
+            scoring="npmi_scorer",
+            threshold=global_options.PHRASE_THRESHOLD,
+        )
+    ],
 )
 
-multiple_word_detect.file_bigramer(
+# apply both phrase models in one pass ----------------
+multiple_word_detect.file_phraser(
     input_path=Path(
-        global_options.DATA_FOLDER, "Processed", "bigram", "documents.txt"
+        global_options.DATA_FOLDER, "Processed", "unigram", "documents.txt"
     ),
     output_path=Path(
         global_options.DATA_FOLDER, "Processed", "trigram", "documents.txt"
     ),
-    model_path=Path(global_options.MODEL_FOLDER, "phrases", "trigram.mod"),
+    model_paths=[
+        Path(global_options.MODEL_FOLDER, "phrases", "bigram.mod"),
+        Path(global_options.MODEL_FOLDER, "phrases", "trigram.mod"),
+    ],
     scoring="npmi_scorer",
     threshold=global_options.PHRASE_THRESHOLD,
+    workers=global_options.N_CORES,
+    pipeline=True,
 )
 #%%
 # train the word2vec model ----------------
@@ -129,6 +145,17 @@ creat_dict(
     output_path=Path(global_options.OUTPUT_FOLDER, "dict", "expanded_dict.csv")
 )
 #%%
+# encode the trigram corpus as a memory-mapped token corpus for scoring
+print(datetime.datetime.now())
+print("Encoding token corpus...")
+token_corpus.build_token_corpus(
+    corpus_file=Path(global_options.DATA_FOLDER, "processed", "trigram", "documents.txt"),
+    output_dir=Path(global_options.DATA_FOLDER, "processed", "trigram", "token_corpus"),
+    sent_id_file=Path(global_options.DATA_FOLDER, "processed", "parsed", "document_sent_ids.txt"),
+    doc_id_file=Path(global_options.DATA_FOLDER, "Input", "document_ids.txt"),
+    int_ids=True,  # parse.parse_document writes integer sentence IDs for a document ID file
+)
+#%%
 # scoring the remarks based on term frequency(or TFIDF, WFIDF...)
 print(datetime.datetime.now())
 print("Scoring samples...")
@@ -136,5 +163,7 @@ run_scoring_pipeline(
     dict_path=Path(global_options.OUTPUT_FOLDER, "dict", "filtered_dict.csv"),
     corpus_path=Path(global_options.DATA_FOLDER, "processed", "trigram", "documents.txt"),
     id_path=Path(global_options.DATA_FOLDER, "processed", "parsed", "document_sent_ids.txt"),
+    doc_id_path=Path(global_options.DATA_FOLDER, "Input", "document_ids.txt"),
+    token_corpus_dir=Path(global_options.DATA_FOLDER, "processed", "trigram", "token_corpus"),
     methods=['TF']
 )
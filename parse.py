@@ -1,58 +1,456 @@
+import functools
+import multiprocessing
 from pathlib import Path
 import global_options
 from Utils.parser import SpacyParser
-from Utils import file_process
+from Utils.parse_cache import ParseCache
+from Utils import doc_store, document_ids, file_process, near_duplicates
+from Utils.parse_server import ParserClient
 
 
-def parse_document(input_path, input_id, output_path, output_id, gpu=False, **kwargs):
-    parser = SpacyParser(use_gpu=gpu)
+def _format_sentences(sent, line_id, int_ids):
+    """Format the sentences of a document and their IDs as output lines.
+
+    Arguments:
+        sent {[(int, str)]} -- (sentence index, sentence) tuples of the document
+        line_id {str or int} -- the document ID, or the document index if int_ids
+        int_ids {bool} -- write sentence IDs as two integer columns
+
+    Returns:
+        str, str -- processed document with each sentence in a line,
+                    sentence IDs with each in its own line: lineID_0 lineID_1 ...
+                    or "lineIndex<TAB>0" "lineIndex<TAB>1" ... if int_ids
+    """
+    # drop blank sentences together with their IDs, so that both outputs stay aligned
+    sent = [item for item in sent if item[1].strip()]
+    sentences = [item[1].strip("\n") for item in sent]
+    if int_ids:
+        sentence_ids = [document_ids.format_sentence_id(line_id, item[0]) for item in sent]
+    else:
+        sentence_ids = [f"{line_id}_{item[0]}" for item in sent]
+
+    processed_sentences = "\n".join(sentences)
+    processed_sentence_ids = "\n".join(sentence_ids)
+
+    return processed_sentences, processed_sentence_ids
+
+
+def _parser_features(kwargs):
+    """Outputs requested by the SpacyParser options, so that the parser enables only the components they need
+
+    Arguments:
+        kwargs {dict} -- options passed to SpacyParser.sentence_split or SpacyParser.pipe_sentences
+
+    Returns:
+        [str] -- requested outputs among "lemma", "ner" and "pos"
+    """
+    return [feature for feature in ("lemma", "ner", "pos") if kwargs.get(feature)]
+
+
+def _open_cache(cache_path, parser, kwargs):
+    """Open the parse cache of a parser, None if there is no cache
+
+    Arguments:
+        cache_path {str, Path or None} -- SQLite database of the cache
+        parser {SpacyParser} -- the parser, its model and profile are part of the cache key
+        kwargs {dict} -- options passed to the parser, part of the cache key
+
+    Returns:
+        ParseCache or None
+    """
+    if cache_path is None:
+        return None
+    return ParseCache(cache_path, parser.config(**kwargs))
+
+
+def _count_cache(cache, cache_counters):
+    """Add the hits and misses of the cache to the shared counters and reset them"""
+    if cache is None or cache_counters is None:
+        return
+    for counter, attribute in zip(cache_counters, ("hits", "misses")):
+        with counter.get_lock():
+            counter.value += getattr(cache, attribute)
+        setattr(cache, attribute, 0)
+
+
+def _line_parser(gpu=False, int_ids=False, parser=None, cache=None, cache_path=None, cache_counters=None,
+                 **kwargs):
+    """Build the function used by file_process.process_large_file to parse a line.
+    The SpacyParser is loaded here, so that each worker process loads the model once.
+
+    Keyword Arguments:
+        gpu {bool} -- use the GPU for spaCy (default: {False})
+        int_ids {bool} -- line IDs are document indices, write sentence IDs as two integer columns (default: {False})
+        parser {SpacyParser} -- an already loaded parser (default: {None})
+        cache {ParseCache} -- an already opened parse cache (default: {None})
+        cache_path {str or Path} -- parse cache to open if cache is None, no cache if None (default: {None})
+        cache_counters {(multiprocessing.Value, multiprocessing.Value)} -- shared hit and miss counters
+            of the cache (default: {None})
+        **kwargs -- options passed to SpacyParser.sentence_split (e.g. lemma=True)
+
+    Returns:
+        callable -- parse_line(line, line_id)
+    """
+    if parser is None:
+        parser = SpacyParser(use_gpu=gpu, features=_parser_features(kwargs))
+    if cache is None:
+        cache = _open_cache(cache_path, parser, kwargs)
+
     def parse_line(line, line_id):
         """Parse each line and return a tuple of sentences, sentence_IDs,
 
         Arguments:
             line {str} -- a document
-            line_id {str} -- the document ID
+            line_id {str or int} -- the document ID, or the document index if int_ids
 
         Returns:
-            str, str -- processed document with each sentence in a line,
-                        sentence IDs with each in its own line: lineID_0 lineID_1 ...
+            str, str -- see _format_sentences
         """
+        sent = cache.get(line) if cache is not None else None
+        if sent is None:
+            try:
+                sent = parser.sentence_split(line, **kwargs)
+                if cache is not None:
+                    cache.put(line, sent)
+            except Exception as e:
+                # the line is written as a document without sentences, so that the outputs stay aligned
+                print(e)
+                print("Exception in line: {}".format(line_id))
+                sent = []
+        _count_cache(cache, cache_counters)
+
+        return _format_sentences(sent, line_id, int_ids)
+
+    return parse_line
+
+
+def _batch_parser(gpu=False, int_ids=False, n_process=1, batch_size=1000, cache_path=None, cache_counters=None,
+                  docbin_dir=None, **kwargs):
+    """Build the batch function used by file_process.process_large_file to parse a chunk of lines
+    with SpacyParser.pipe_sentences (nlp.pipe). The lines of a chunk are sent to spaCy sorted by length,
+    so that each batch has documents of similar length, and the output is in input order.
+
+    Keyword Arguments:
+        gpu {bool} -- use the GPU for spaCy, n_process is then 1 (default: {False})
+        int_ids {bool} -- line IDs are document indices, write sentence IDs as two integer columns (default: {False})
+        n_process {int} -- number of spaCy processes (default: {1})
+        batch_size {int} -- number of documents in each spaCy batch (default: {1000})
+        cache_path {str or Path} -- parse cache, only the documents that are not in it are parsed (default: {None})
+        cache_counters {(multiprocessing.Value, multiprocessing.Value)} -- shared hit and miss counters
+            of the cache (default: {None})
+        docbin_dir {str or Path} -- store the Docs of each chunk in a DocBin shard of this folder, the parser then
+            runs the components of all the stored annotations and the cache is not used (default: {None})
+        **kwargs -- options passed to SpacyParser.pipe_sentences (e.g. lemma=True)
+
+    Returns:
+        callable -- parse_lines(lines, line_ids)
+    """
+    if docbin_dir is not None:
+        parser = SpacyParser(use_gpu=gpu, features=doc_store.STORED_FEATURES)
+        cache_path = None
+    else:
+        parser = SpacyParser(use_gpu=gpu, features=_parser_features(kwargs))
+    cache = _open_cache(cache_path, parser, kwargs)
+    if gpu:
+        n_process = 1
+
+    def parse_and_store(lines, line_ids):
+        """Parse a chunk of lines, store their Docs in a shard named by the first line and render them"""
         try:
-            sent = parser.sentence_split(line, **kwargs)
+            docs = [
+                doc for doc, _ in parser.pipe_docs(
+                    lines, batch_size=batch_size, n_process=n_process, sort_window=len(lines)
+                )
+            ]
         except Exception as e:
+            # parse the chunk line by line, a failing line is stored as an empty Doc
             print(e)
-            print("Exception in line: {}".format(line_id))
+            print("Exception in the batch starting at line: {}, parsing it line by line.".format(line_ids[0]))
+            docs = []
+            for line, line_id in zip(lines, line_ids):
+                try:
+                    docs.append(parser.nlp(line))
+                except Exception as e:
+                    print(e)
+                    print("Exception in line: {}".format(line_id))
+                    docs.append(parser.nlp.make_doc(""))
+        doc_store.write_shard(docs, docbin_dir, line_ids[0])
+        render_options = {k: kwargs.get(k, False) for k in ("lemma", "ner", "pos")}
+        outputs = [
+            _format_sentences(
+                [(idx, parser.render_sentence(sent, **render_options)) for idx, sent in enumerate(doc.sents)],
+                line_id,
+                int_ids,
+            )
+            for doc, line_id in zip(docs, line_ids)
+        ]
+        return [o[0] for o in outputs], [o[1] for o in outputs]
 
-        sentences = [item[1].strip("\n") for item in sent if item[1].strip()]
-        sentence_ids = [f"{line_id}_{item[0]}" for item in sent]
+    def parse_lines(lines, line_ids):
+        """Parse a chunk of lines, see parse_line"""
+        if docbin_dir is not None:
+            return parse_and_store(lines, line_ids)
+        if cache is not None:
+            doc_sentences = cache.get_many(lines)
+            missing = [i for i, sent in enumerate(doc_sentences) if sent is None]
+            _count_cache(cache, cache_counters)
+        else:
+            doc_sentences = [None] * len(lines)
+            missing = list(range(len(lines)))
+        try:
+            for i in missing:
+                doc_sentences[i] = []
+            for i, idx, sentence_text in parser.pipe_sentences(
+                [lines[i] for i in missing], ids=missing, batch_size=batch_size, n_process=n_process,
+                sort_window=len(missing), **kwargs
+            ):
+                doc_sentences[i].append((idx, sentence_text))
+            if cache is not None and missing:
+                cache.put_many([lines[i] for i in missing], [doc_sentences[i] for i in missing])
+            outputs = [
+                _format_sentences(sent, line_id, int_ids) for sent, line_id in zip(doc_sentences, line_ids)
+            ]
+        except Exception as e:
+            # parse the missing lines one by one, so that only the failing lines are lost;
+            # the cached lines were already looked up (and counted)
+            print(e)
+            print("Exception in the batch starting at line: {}, parsing it line by line.".format(line_ids[0]))
+            for i in missing:
+                try:
+                    doc_sentences[i] = parser.sentence_split(lines[i], **kwargs)
+                    if cache is not None:
+                        cache.put(lines[i], doc_sentences[i])
+                except Exception as e:
+                    print(e)
+                    print("Exception in line: {}".format(line_ids[i]))
+                    doc_sentences[i] = []
+            outputs = [
+                _format_sentences(sent, line_id, int_ids) for sent, line_id in zip(doc_sentences, line_ids)
+            ]
+        return [o[0] for o in outputs], [o[1] for o in outputs]
+
+    return parse_lines
+
+
+def _remote_parser(socket_path, int_ids=False, **kwargs):
+    """Build the batch function used by file_process.process_large_file to parse a chunk of lines
+    with a parse server (see Utils.parse_server), so that no model is loaded in this process.
+
+    Arguments:
+        socket_path {str or Path} -- Unix domain socket of the server
+
+    Keyword Arguments:
+        int_ids {bool} -- line IDs are document indices, write sentence IDs as two integer columns (default: {False})
+        **kwargs -- options passed to SpacyParser.pipe_sentences on the server (e.g. lemma=True)
 
-        processed_sentences = "\n".join(sentences)
-        processed_sentence_ids = "\n".join(sentence_ids)
+    Returns:
+        callable -- parse_lines(lines, line_ids)
+    """
+    client = ParserClient(socket_path)
 
-        return processed_sentences, processed_sentence_ids
+    def parse_lines(lines, line_ids):
+        """Parse a chunk of lines on the server, see parse_line"""
+        outputs = [
+            _format_sentences(sent, line_id, int_ids)
+            for sent, line_id in zip(client.parse(list(lines), **kwargs), line_ids)
+        ]
+        return [o[0] for o in outputs], [o[1] for o in outputs]
 
+    return parse_lines
+
+
+def parse_document(input_path, input_id, output_path, output_id, gpu=False, workers=1, resume=False, pipeline=False,
+                   batch=False, batch_size=None, cache_path=None, dedup_threshold=None, docbin_dir=None, server=None,
+                   **kwargs):
+    """Parse the documents in input_path, write one sentence per line to output_path
+    and the sentence IDs to output_id.
+    If input_id is the path of the document ID file, the IDs are not loaded: each sentence ID is written as
+    two integer columns (line number of the document, sentence index), see Utils.document_ids.
+    If input_id is a list of document IDs, each sentence ID is written as docID_sentenceID.
+
+    Arguments:
+        input_path {str or Path} -- input text file, each line is a document
+        input_id {str, Path or [str]} -- document ID file, or document IDs of the lines in input_path
+        output_path {str or Path} -- parsed sentence file
+        output_id {str or Path} -- sentence ID file
+
+    Keyword Arguments:
+        gpu {bool} -- use the GPU for spaCy (default: {False})
+        workers {int} -- number of parser processes, each loads its own model (default: {1})
+        resume {bool} -- continue an interrupted run from its checkpoint manifest (default: {False})
+        pipeline {bool} -- overlap reading, parsing and writing with bounded queues (default: {False})
+        batch {bool} -- parse with nlp.pipe in batches of batch_size documents, using workers spaCy processes (default: {False})
+        batch_size {int} -- number of documents in each spaCy batch (default: {global_options.PARSE_CHUNK_SIZE})
+        cache_path {str or Path} -- SQLite parse cache keyed by the document text, the model and the options;
+            only the documents that are not in it are parsed, the hit rate is printed at the end (default: {None})
+        dedup_threshold {float} -- cluster the near-duplicate documents (Jaccard similarity of word shingles above
+            the threshold) in a near_duplicates folder next to output_path, parse one representative per cluster
+            and copy its sentences to the other members; requires the document ID file as input_id (default: {None})
+        docbin_dir {str or Path} -- also store the annotated Docs (lemmas, entities, POS tags, sentences) in sharded
+            DocBin files of this folder, so that render_documents can write any lemma/ner/pos variant without
+            parsing again; requires batch, single_pass=True and the document ID file as input_id.
+            With dedup_threshold, the Docs of the representatives are stored (default: {None})
+        server {str or Path} -- Unix domain socket of a running parse server (python -m Utils.parse_server):
+            the chunks of batch_size documents are parsed by its resident model instead of loading one here;
+            gpu, workers and cache_path are then not used (default: {None})
+        **kwargs -- options passed to SpacyParser.sentence_split (e.g. lemma=True)
+    """
+    int_ids = isinstance(input_id, (str, Path))
+    if dedup_threshold is not None:
+        assert int_ids, "Near-duplicate detection requires the document ID file as input_id."
+        dedup_dir = Path(output_path).parent / "near_duplicates"
+        near_duplicates.deduplicate_file(
+            input_path, input_id, dedup_dir, threshold=dedup_threshold, workers=workers
+        )
+        parse_document(
+            input_path=dedup_dir / near_duplicates.REPRESENTATIVES_FILE,
+            input_id=dedup_dir / near_duplicates.REPRESENTATIVE_IDS_FILE,
+            output_path=dedup_dir / "parsed_documents.txt",
+            output_id=dedup_dir / "parsed_sent_ids.txt",
+            gpu=gpu,
+            workers=workers,
+            resume=resume,
+            pipeline=pipeline,
+            batch=batch,
+            batch_size=batch_size,
+            cache_path=cache_path,
+            docbin_dir=docbin_dir,
+            server=server,
+            **kwargs,
+        )
+        near_duplicates.expand_clusters(
+            dedup_dir / "parsed_documents.txt",
+            dedup_dir / "parsed_sent_ids.txt",
+            dedup_dir / near_duplicates.CLUSTERS_FILE,
+            output_path,
+            output_id,
+        )
+        return
+    if int_ids:
+        assert file_process.line_counter(input_path) == file_process.line_counter(input_id), \
+            "Make sure the input file has the same number of rows as the input ID file. "
+        input_id = None
+    if docbin_dir is not None:
+        assert batch and int_ids and kwargs.get("single_pass"), \
+            "Storing the Docs requires batch=True, single_pass=True and the document ID file as input_id."
+        if not resume:
+            doc_store.clear_shards(docbin_dir)
+        cache_path = None
+    if server is not None:
+        assert docbin_dir is None, "The Docs cannot be stored when parsing with a server."
+        cache_path = None
+    cache_counters = None
+    if cache_path is not None:
+        cache_counters = (multiprocessing.Value("q", 0), multiprocessing.Value("q", 0))
+    if server is not None:
+        function_factory = functools.partial(_remote_parser, socket_path=server, int_ids=int_ids, **kwargs)
+        chunk_size = batch_size if batch_size is not None else global_options.PARSE_CHUNK_SIZE
+        workers = 1
+        batch = True
+    elif batch:
+        if batch_size is None:
+            batch_size = global_options.PARSE_CHUNK_SIZE
+        # spaCy starts its processes for each chunk, give each process a few batches per chunk
+        function_factory = functools.partial(
+            _batch_parser, gpu=gpu, int_ids=int_ids, n_process=workers, batch_size=batch_size,
+            cache_path=cache_path, cache_counters=cache_counters, docbin_dir=docbin_dir, **kwargs
+        )
+        chunk_size = batch_size * max(workers, 1) * 4
+        workers = 1
+    else:
+        function_factory = functools.partial(
+            _line_parser, gpu=gpu, int_ids=int_ids, cache_path=cache_path, cache_counters=cache_counters, **kwargs
+        )
+        chunk_size = global_options.PARSE_CHUNK_SIZE
     file_process.process_large_file(
         input_file=input_path,
         input_file_ids=input_id,
         output_file=output_path,
         output_index_file=output_id,
-        function_name=parse_line,
-        chunk_size=global_options.PARSE_CHUNK_SIZE
+        function_factory=function_factory,
+        chunk_size=chunk_size,
+        workers=workers,
+        resume=resume,
+        pipeline=pipeline,
+        batched=batch,
+        params={"stage": "parse", "gpu": gpu, "int_ids": int_ids, **kwargs},
     )
+    if docbin_dir is not None:
+        doc_store.finalize_shards(docbin_dir, file_process.line_counter(input_path))
+    if cache_counters is not None:
+        hits, misses = cache_counters[0].value, cache_counters[1].value
+        print(
+            "Parse cache: {} hits, {} misses, hit rate {:.1%}.".format(
+                hits, misses, hits / (hits + misses) if hits + misses else 0
+            )
+        )
+
+
+def render_documents(docbin_dir, output_path, output_id, workers=1, lemma=False, ner=False, pos=False):
+    """Write the sentences and sentence IDs of the Docs stored by parse_document(docbin_dir=...) with other
+    lemma/ner/pos options, in the same format as parse_document with the document ID file as input_id.
+    Only the stored annotations are read, the spaCy pipeline is not run.
+    For a corpus parsed with dedup_threshold, the output is the representatives, see near_duplicates.expand_clusters.
+
+    Arguments:
+        docbin_dir {str or Path} -- folder of the DocBin shards
+        output_path {str or Path} -- parsed sentence file
+        output_id {str or Path} -- sentence ID file
+
+    Keyword Arguments:
+        workers {int} -- number of processes rendering the shards (default: {1})
+        lemma {bool} -- use the lemmas (default: {False})
+        ner {bool} -- apply NER formatting (default: {False})
+        pos {bool} -- append POS tags (default: {False})
+    """
+    shards = doc_store.shard_files(docbin_dir)
+    render = functools.partial(doc_store.render_shard, lemma=lemma, ner=ner, pos=pos)
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    results = pool.imap(render, shards) if pool is not None else map(render, shards)
+    next_line = 0
+    try:
+        with file_process.open_file(output_path, "w", encoding="utf-8", newline="\n") as f_out, \
+                file_process.open_file(output_id, "w", encoding="utf-8", newline="\n") as f_out_ids:
+            for first_line, doc_sentences in results:
+                if first_line != next_line:
+                    raise ValueError(
+                        "The shards of {} are not contiguous: expected line {}, found {}.".format(
+                            docbin_dir, next_line, first_line
+                        )
+                    )
+                for k, sent in enumerate(doc_sentences):
+                    processed_sentences, processed_sentence_ids = _format_sentences(sent, first_line + k, True)
+                    f_out.write(processed_sentences + "\n")
+                    f_out_ids.write(processed_sentence_ids + "\n")
+                next_line = first_line + len(doc_sentences)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    file_process.build_line_index(output_path)
+    file_process.build_line_index(output_id)
+    print("Rendered {} documents from {}.".format(next_line, docbin_dir))
+
 
 if __name__ == "__main__":
     parse_document(
         input_path=Path(
             global_options.DATA_FOLDER, "Input", "documents.txt"
         ),
-        input_id=file_process.file_to_list(Path(
+        input_id=Path(
             global_options.DATA_FOLDER, "Input", "document_ids.txt"
-        )),
+        ),
         output_path=Path(
             global_options.DATA_FOLDER, "processed", "parsed", "documents.txt"
         ),
         output_id=Path(
             global_options.DATA_FOLDER, "processed", "parsed", "document_sent_ids.txt"
         ),
-        lemma=True
+        workers=global_options.N_CORES,
+        batch=True,
+        cache_path=Path(
+            global_options.DATA_FOLDER, "processed", "parsed", "parse_cache.sqlite"
+        ),
+        lemma=True,
+        single_pass=True
     )
\ No newline at end of file
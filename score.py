@@ -1,3 +1,4 @@
+import contextlib
 import itertools
 import os
 import pickle
@@ -9,37 +10,57 @@ import pandas as pd
 from tqdm import tqdm as tqdm
 
 import global_options
-from Utils import dictionary, file_process
+from Utils import dictionary, document_ids, file_process, token_corpus
 
 
 # @TODO: The scoring functions are not memory friendly. The entire processed corpus needs to fit in the RAM. Rewrite a memory friendly version.
 
 
-def construct_doc_level_corpus(sent_corpus_file, sent_id_file):
+def construct_doc_level_corpus(sent_corpus_file, sent_id_file, doc_id_file=None, int_ids=None):
     """Construct document level corpus from sentence level corpus and write to disk.
     Dump "corpus_doc_level.pickle" and "doc_ids.pickle" to Path(global_options.OUTPUT_FOLDER, "scores", "temp"). 
 
     Arguments:
         sent_corpus_file {str or Path} -- The sentence corpus after parsing and cleaning, each line is a sentence
-        sent_id_file {str or Path} -- The sentence ID file, each line correspond to a line in the sent_co(docID_sentenceID)
+        sent_id_file {str or Path} -- The sentence ID file, each line correspond to a line in the sent_corpus_file,
+            either two integer columns (document index, sentence index) or docID_sentenceID
+        doc_id_file {str or Path} -- The document ID file, required to map document indices to IDs (default: {None})
+        int_ids {bool} -- the sentence IDs are two integer columns, detected from the file if None
+            (see document_ids.is_int_sentence_id_file) (default: {None})
 
     Returns:
         [str], [str], int -- a tuple of a list of documents, a list of document IDs, and the number of documents
     """
     print("Constructing doc level corpus")
-    # sentence level corpus
-    sent_corpus = file_process.file_to_list(sent_corpus_file)
-    sent_IDs = file_process.file_to_list(sent_id_file)
-    assert len(sent_IDs) == len(sent_corpus)
-    # doc id for each sentence
-    doc_ids = [x.split("_")[0] for x in sent_IDs]
+    assert file_process.line_counter(sent_corpus_file) == file_process.line_counter(sent_id_file)
+    if int_ids is None:
+        int_ids = document_ids.is_int_sentence_id_file(sent_id_file)
+    if int_ids and doc_id_file is None:
+        raise ValueError("doc_id_file is required for sentence IDs with document indices.")
     # concat all text from the same doc
-    id_doc_dict = defaultdict(lambda: "")
-    for i, id in enumerate(doc_ids):
-        id_doc_dict[id] += " " + sent_corpus[i]
+    id_doc_dict = defaultdict(list)
+    with file_process.open_file(sent_corpus_file, "rb") as f_corpus, contextlib.ExitStack() as stack:
+        if int_ids:
+            sent_doc_keys, _ = document_ids.read_sentence_ids(sent_id_file)
+        else:
+            f_ids = stack.enter_context(file_process.open_file(sent_id_file, "rb"))
+            # the sentence index is after the last "_", document IDs may contain "_"
+            sent_doc_keys = (x.decode(encoding="utf-8").strip().rsplit("_", 1)[0] for x in f_ids)
+        # doc id (or doc index) for each sentence, streamed alongside the sentences
+        for key, sentence in zip(sent_doc_keys, f_corpus):
+            if int_ids and key < 0:
+                # blank line of a document without any sentence
+                continue
+            id_doc_dict[key].append(sentence.decode(encoding="utf-8").strip())
     # create doc level corpus
-    corpus = list(id_doc_dict.values())
-    doc_ids = list(id_doc_dict.keys())
+    corpus = [" " + " ".join(sentences) for sentences in id_doc_dict.values()]
+    if int_ids:
+        doc_id_table = document_ids.DocumentIds(doc_id_file)
+        doc_ids = [doc_id_table[int(i)] for i in id_doc_dict.keys()]
+        doc_id_table.close()
+    else:
+        doc_ids = list(id_doc_dict.keys())
+    del id_doc_dict
     assert len(corpus) == len(doc_ids)
     with open(
             Path(global_options.OUTPUT_FOLDER, "scores", "temp", "corpus_doc_level.pickle"),
@@ -170,11 +191,60 @@ def score_tf_idf(documents, doc_ids, N_doc, method, expanded_dict, **kwargs):
         )
 
 
+def score_token_corpus(corpus, method, expanded_dict, df_array, **kwargs):
+    """Score a token corpus using tf or tf-idf and its variations with NumPy.
+    Writes the same files as score_tf_idf.
+
+    Arguments:
+        corpus {Utils.token_corpus.TokenCorpus} -- the integer-encoded corpus
+        method {str} -- TF, TFIDF, WFIDF, TFIDF+SIMWEIGHT or WFIDF+SIMWEIGHT
+        expanded_dict {dict[str, set(str)]} -- expanded dictionary
+        df_array {numpy.ndarray} -- document frequency of each word ID
+    """
+    if method == "TF":
+        print("Scoring TF.")
+        score = dictionary.score_tf_token_corpus(corpus, expanded_dict)
+        score.to_csv(
+            Path(global_options.OUTPUT_FOLDER, "scores", "scores_TF.csv"), index=False
+        )
+        return
+    print("Scoring TF-IDF.")
+    score, contribution = dictionary.score_tf_idf_token_corpus(
+        token_corpus=corpus,
+        expanded_words=expanded_dict,
+        df_array=df_array,
+        method=method,
+        **kwargs
+    )
+    # save the document level scores (without dividing by doc length)
+    score.to_csv(
+        str(
+            Path(
+                global_options.OUTPUT_FOLDER,
+                "scores",
+                "scores_{}.csv".format(method),
+            )
+        ),
+        index=False,
+    )
+    # save word contributions
+    pd.DataFrame.from_dict(contribution, orient="index").to_csv(
+        Path(
+            global_options.OUTPUT_FOLDER,
+            "scores",
+            "word_contributions",
+            "word_contribution_{}.csv".format(method),
+        )
+    )
+
+
 def run_scoring_pipeline(
     dict_path,
     corpus_path,
     id_path,
     methods,
+    doc_id_path=None,
+    token_corpus_dir=None,
     **kwargs
 ):
     """
@@ -194,6 +264,11 @@ def run_scoring_pipeline(
         Path to the file containing sentence IDs corresponding to the corpus.
     methods : list of str
         A list of methods to run. E.g. ["TF", "TFIDF", "WFIDF", ...].
+    doc_id_path : str or Path, optional
+        Path to the document ID file, required if the sentence IDs are document indices.
+    token_corpus_dir : str or Path, optional
+        Folder of the integer-encoded corpus (Utils.token_corpus). If given, steps 2-4 run
+        with NumPy on the memory-mapped corpus instead of corpus_path and id_path.
     **kwargs : dict
         Any additional arguments you want passed to the 'score_tf_idf' function.
         For instance, you can include:
@@ -207,10 +282,27 @@ def run_scoring_pipeline(
     # (Optional) words weighted by similarity rank
     word_sim_weights = dictionary.compute_word_sim_weights(dict_path)
 
+    if token_corpus_dir is not None:
+        # 2-4. Document frequency and scores on the memory-mapped token corpus
+        corpus = token_corpus.TokenCorpus(token_corpus_dir)
+        print("Calculating document frequencies.")
+        df_array = corpus.document_frequency()
+        for method in methods:
+            score_token_corpus(
+                corpus=corpus,
+                method=method,
+                expanded_dict=dict,
+                df_array=df_array,
+                word_weights=word_sim_weights,
+                **kwargs
+            )
+        return
+
     # 2. Create document-level corpus
     corpus, doc_ids, N_doc = construct_doc_level_corpus(
         sent_corpus_file=corpus_path,
-        sent_id_file=id_path
+        sent_id_file=id_path,
+        doc_id_file=doc_id_path,
     )
 
     # 3. Calculate document frequency
@@ -234,5 +326,6 @@ if __name__ == "__main__":
         dict_path=Path(global_options.OUTPUT_FOLDER, "dict", "expanded_dict.csv"),
         corpus_path=Path(global_options.DATA_FOLDER, "processed", "trigram", "documents.txt"),
         id_path=Path(global_options.DATA_FOLDER, "processed", "parsed", "document_sent_ids.txt"),
+        doc_id_path=Path(global_options.DATA_FOLDER, "Input", "document_ids.txt"),
         methods=['TF']
     )
\ No newline at end of file
@@ -0,0 +1,181 @@
+import datetime
+import itertools
+from multiprocessing import Pool
+from pathlib import Path
+
+import pandas as pd
+
+import global_options
+from creat_dictionary import creat_dict
+from Utils import dictionary, multiple_word_detect, train_models_untils
+
+
+def _configs(grid):
+    """All the combinations of a parameter grid {name: [values]}, in the order of the grid"""
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+
+def _config_name(config):
+    """Folder name of a configuration, e.g. vector_size300_window5_sg0"""
+    return "_".join("{}{}".format(name, int(value) if isinstance(value, bool) else value)
+                    for name, value in config.items())
+
+
+def _train_and_expand(job):
+    """Train the word2vec model of one configuration and expand the seed words with it"""
+    start = datetime.datetime.now()
+    print("{} Training {}...".format(start, job["name"]))
+    model = train_models_untils.train_w2v_from_vocab(
+        input_path=job["corpus_path"], vocab_path=job["vocab_path"], model_path=job["model_path"], **job["w2v_params"]
+    )
+    train_seconds = (datetime.datetime.now() - start).total_seconds()
+    creat_dict(input_path=job["model_path"], output_path=job["dict_path"])
+    return job["name"], {"vocab_size": len(model.wv.key_to_index), "train_seconds": train_seconds}
+
+
+def _jaccard(a, b):
+    return len(a & b) / len(a | b) if a | b else 1.0
+
+
+def compare_dictionaries(dict_paths):
+    """Compare expanded dictionaries dimension by dimension.
+
+    Arguments:
+        dict_paths {dict[str, Path]} -- {name: expanded dictionary CSV}, see creat_dictionary.creat_dict
+
+    Returns:
+        pandas.DataFrame -- one row per dictionary: the number of words of each dimension ("n_words:<dimension>"),
+            and its overlap with each dictionary ("overlap:<name>", mean Jaccard similarity of the dimensions)
+    """
+    dicts = {name: dictionary.read_dict_from_csv(path)[0] for name, path in dict_paths.items()}
+    dimensions = sorted(set().union(*(d.keys() for d in dicts.values())))
+    rows = []
+    for name, words in dicts.items():
+        row = {"config": name}
+        for dimension in dimensions:
+            row["n_words:" + dimension] = len(words.get(dimension, set()))
+        for other_name, other_words in dicts.items():
+            row["overlap:" + other_name] = sum(
+                _jaccard(words.get(dimension, set()), other_words.get(dimension, set())) for dimension in dimensions
+            ) / max(len(dimensions), 1)
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def sweep_w2v(grid, output_dir, corpus_path=None, unigram_path=None, phrase_model_paths=None, total_cores=None,
+              workers_per_config=None):
+    """Train a word2vec model for each combination of a parameter grid, expand the seed words with each model
+    and compare the expanded dictionaries in one table, instead of editing global_options and re-running main.py.
+
+    The vocab of each corpus is scanned once and shared by the models trained on it
+    (see train_models_untils.scan_w2v_vocab), and the models are trained concurrently:
+    total_cores // workers_per_config models at a time, each with workers_per_config threads.
+
+    Arguments:
+        grid {dict[str, list]} -- values of Word2Vec parameters (e.g. vector_size, window, sg, min_count),
+            and optionally of "phrase_threshold"; a parameter not in the grid is taken from global_options
+            (W2V_DIM, W2V_WINDOW, W2V_SKIP, W2V_ITER)
+        output_dir {str or Path} -- folder of the sweep: <config>/w2v.mod, <config>/expanded_dict.csv,
+            comparison.csv
+
+    Keyword Arguments:
+        corpus_path {str or Path} -- training corpus (e.g. the trigram corpus), required without phrase_threshold
+            in the grid (default: {None})
+        unigram_path {str or Path} -- unigram corpus, re-phrased with phrase_model_paths at each phrase_threshold
+            of the grid; the phrase counts are not re-learned, only the threshold changes (default: {None})
+        phrase_model_paths {list} -- phrase models, applied in order, see multiple_word_detect.file_phraser
+            (default: {None})
+        total_cores {int} -- number of cores used by the sweep (default: {global_options.N_CORES})
+        workers_per_config {int} -- threads of each model, the cores shared by all the configurations
+            if None (default: {None})
+
+    Returns:
+        pandas.DataFrame -- one row per configuration: its parameters, vocab size, training time,
+            and the comparison of its expanded dictionary (see compare_dictionaries); also saved as comparison.csv
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    if total_cores is None:
+        total_cores = global_options.N_CORES
+    configs = _configs(grid)
+    if workers_per_config is None:
+        workers_per_config = max(total_cores // len(configs), 1)
+    n_jobs = max(total_cores // workers_per_config, 1)
+
+    # one corpus and one vocab for each phrase threshold
+    corpora = {}
+    for threshold in grid.get("phrase_threshold", [None]):
+        corpus_dir = output_dir if threshold is None else output_dir / "phrase_threshold{}".format(threshold)
+        if threshold is None:
+            corpus = train_models_untils.line_sentence_file(corpus_path, corpus_dir / "w2v_corpus.txt")
+        else:
+            if unigram_path is None or phrase_model_paths is None:
+                raise ValueError("unigram_path and phrase_model_paths are required to sweep phrase_threshold.")
+            corpus = corpus_dir / "documents.txt"
+            print(datetime.datetime.now())
+            print("Phrasing the corpus at threshold {}...".format(threshold))
+            multiple_word_detect.file_phraser(
+                input_path=unigram_path,
+                output_path=corpus,
+                model_paths=phrase_model_paths,
+                threshold=threshold,
+                scoring="npmi_scorer",
+                workers=total_cores,
+            )
+        vocab_path = train_models_untils.scan_w2v_vocab(corpus, corpus_dir / "w2v_vocab.pkl")
+        corpora[threshold] = (corpus, vocab_path)
+
+    jobs = []
+    for config in configs:
+        name = _config_name(config)
+        w2v_params = {
+            "vector_size": global_options.W2V_DIM,
+            "window": global_options.W2V_WINDOW,
+            "sg": global_options.W2V_SKIP,
+            "epochs": global_options.W2V_ITER,
+        }
+        w2v_params.update({k: v for k, v in config.items() if k != "phrase_threshold"})
+        w2v_params["workers"] = workers_per_config
+        corpus, vocab_path = corpora[config.get("phrase_threshold")]
+        jobs.append({
+            "name": name,
+            "corpus_path": corpus,
+            "vocab_path": vocab_path,
+            "model_path": output_dir / name / "w2v.mod",
+            "dict_path": output_dir / name / "expanded_dict.csv",
+            "w2v_params": w2v_params,
+        })
+
+    print(datetime.datetime.now())
+    print("Training {} configurations, {} at a time with {} workers each...".format(
+        len(jobs), n_jobs, workers_per_config))
+    with Pool(n_jobs, maxtasksperchild=1) as pool:
+        results = dict(pool.imap_unordered(_train_and_expand, jobs))
+
+    comparison = compare_dictionaries({job["name"]: job["dict_path"] for job in jobs})
+    summary = pd.DataFrame(configs)
+    summary.insert(0, "config", [job["name"] for job in jobs])
+    summary["vocab_size"] = [results[job["name"]]["vocab_size"] for job in jobs]
+    summary["train_seconds"] = [results[job["name"]]["train_seconds"] for job in jobs]
+    comparison = summary.merge(comparison, on="config")
+    comparison.to_csv(output_dir / "comparison.csv", index=False)
+    print(comparison.to_string(index=False))
+    return comparison
+
+
+if __name__ == "__main__":
+    sweep_w2v(
+        grid={
+            "vector_size": [100, global_options.W2V_DIM],
+            "window": [global_options.W2V_WINDOW, 10],
+            "sg": [global_options.W2V_SKIP],
+            "phrase_threshold": [global_options.PHRASE_THRESHOLD],
+        },
+        output_dir=Path(global_options.MODEL_FOLDER, "w2v_sweep"),
+        unigram_path=Path(global_options.DATA_FOLDER, "processed", "unigram", "documents.txt"),
+        phrase_model_paths=[
+            Path(global_options.MODEL_FOLDER, "phrases", "bigram.mod"),
+            Path(global_options.MODEL_FOLDER, "phrases", "trigram.mod"),
+        ],
+    )